@@ -12,6 +12,7 @@ import tensorflow_addons as tfa
 from keras import backend as b
 import morpho_dataset
 import morpho_dataset_simple as mds
+from gradient_accumulator import GradientAccumulator
 import pickle
 import warnings
 from transformers import WarmUp
@@ -39,6 +40,8 @@ class BertModel:
             self.model = transformers.TFAutoModel.from_pretrained(name,
                                                               config=self.config)
         self.embeddings_only = True if args.bert else False                                                     
+        self.window = args.bert_window
+        self.window_overlap = args.bert_window_overlap
 
 
 class Network:
@@ -90,6 +93,7 @@ class Network:
             self.model.load_weights(args.bert_load)
         # compile model
         self.optimizer=tf.optimizers.Adam()
+        self._accumulator = GradientAccumulator()
         if args.decay_type is not None:
             decay_steps = args.steps_in_epoch * (args.epochs[0][0] - args.warmup_decay)
             if args.decay_type == "i":
@@ -172,7 +176,6 @@ class Network:
             if args.accu>1:
                 self.optimizer.learning_rate = self.optimizer.learning_rate/args.accu
 
-        num_gradients = 0
 
         while not dataset.epoch_finished():
             sentence_lens, batch = dataset.next_batch(args.batch_size, args.word_dropout)
@@ -187,7 +190,6 @@ class Network:
             #print("WI", batch[dataset.data.FORMS].word_ids)
             #print("CS", batch[dataset.data.FORMS].charseqs)
             #print("CSI", batch[dataset.data.FORMS].charseq_ids, flush=True)
-            print('train epoch')
 
             #TODO neměla bych prumerovat metriky?
 
@@ -196,31 +198,9 @@ class Network:
             if args.accu < 2:
                 self.optimizer.apply_gradients(zip(tg, self.model.trainable_variables))
             else:
-                if num_gradients == 0:
-                    gradients = []
-                    for index, g in enumerate(tg):
-                        if g == None:
-                            gradients.append(None)
-                        elif not isinstance(g, tf.IndexedSlices):
-                            gradients.append(g.numpy())
-                        else:
-                            gradients.append([(g.values.numpy(), g.indices.numpy())])
-
-                    # gradients = [
-                    #   g.numpy() if not isinstance(g, tf.IndexedSlices) else [(g.values.numpy(), g.indices.numpy())] for g
-                    #   in tg]
-                else:
-
-                    for g, ng in zip(gradients, tg):
-                        if ng != None:
-                            if isinstance(g, list):
-                                g.append((ng.values.numpy(), ng.indices.numpy()))
-                            else:
-                                g += ng.numpy()
-                num_gradients += 1
-                if num_gradients == args.accu or len(dataset.data._permutation) == 0:
-                    gradients = [tf.IndexedSlices(*map(np.concatenate, zip(*g))) if isinstance(g, list) else g for g in
-                                 gradients]
+                self._accumulator.accumulate(tg)
+                if self._accumulator.steps == args.accu or len(dataset.data._permutation) == 0:
+                    gradients = self._accumulator.gradients()
                     if args.fine_lr > 0:
                         variables = self.model.trainable_variables
                         var1 = variables[0: args.lr_split]
@@ -234,41 +214,20 @@ class Network:
                         print("trainable variables")
                         print(str(len(self.model.trainable_variables)))
                         self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
-                    num_gradients = 0
+                    self._accumulator.reset()
 
     # TODO create inputs jako jednu metodu pro train i evaluate!
     # TODO vytvareni modelu jako jedna metoda pro outer i inner model
     def _compute_bert(self, batch, dataset, lenghts):
-
-        max_len = batch[dataset.EMBEDDINGS].word_ids.shape[1]
-        result = np.zeros((len(batch[dataset.BERT].word_ids), max_len, len(batch[dataset.BERT].word_ids[0][0])))
-        for sentence in range(len(batch[dataset.BERT].word_ids)):
-            result[sentence][0:len(batch[dataset.BERT].word_ids[sentence])] = batch[dataset.BERT].word_ids[sentence]
-
-        return result
+        # The batch already contains the padded float32 BERT embeddings
+        return batch[dataset.BERT].word_ids
 
     def _compute_embeddings(self, batch, dataset):
-        embeddings = np.zeros([batch[dataset.EMBEDDINGS].word_ids.shape[0],
-                               batch[dataset.EMBEDDINGS].word_ids.shape[1],
-                               args.embeddings_size])
-        for i in range(embeddings.shape[0]):
-            for j in range(embeddings.shape[1]):
-                if batch[dataset.EMBEDDINGS].word_ids[i, j]:
-                    embeddings[i, j] = args.embeddings_data[batch[dataset.EMBEDDINGS].word_ids[i, j] - 1]
+        word_ids = batch[dataset.EMBEDDINGS].word_ids
+        embeddings = np.zeros(word_ids.shape + (args.embeddings_size,), np.float32)
+        embeddings[word_ids > 0] = args.embeddings_data[word_ids[word_ids > 0] - 1]
         return embeddings
 
-    # TODO predelat, kdyz uz to vraci rovnou embeddings
-    def _compute_bert_embeddings(self, batch, dataset):
-        bert_embeddings = np.zeros([batch[dataset.BERT].word_ids.shape[0],
-                                    batch[dataset.BERT].word_ids.shape[1],
-                                    args.bert_size])
-        for i in range(bert_embeddings.shape[0]):
-            for j in range(bert_embeddings.shape[1]):
-                if batch[dataset.BERT].word_ids[i, j]:
-                    bert_embeddings[i, j] = dataset.bert_embeddings[batch[dataset.BERT].word_ids[i, j] - 1]
-
-        return bert_embeddings
-
     @tf.function(experimental_relax_shapes=True)
     def evaluate_batch(self, inputs, factors):
         #tags_mask =  tf.pad(factors[0][:, 1:] != 0, [[0, 0], [1, 0]], constant_values=True)
@@ -447,6 +406,9 @@ if __name__ == "__main__":
     parser.add_argument("--label_smoothing", default=0.03, type=float, help="Label smoothing.")
     parser.add_argument("--layers", default=None, type=str, help="Which layers should be used")
     parser.add_argument("--bert_model", default=None, type=str, help="Model for loading")
+    parser.add_argument("--bert_window", default=512, type=int,
+                        help="Maximum subwords encoded by bert at once, longer sentences are split into windows.")
+    parser.add_argument("--bert_window_overlap", default=128, type=int, help="Subwords shared by consecutive windows.")
     parser.add_argument("--threads", default=4, type=int, help="Maximum number of threads to use.")
     parser.add_argument("--warmup_decay", default="None", type=str,help="Number of warmup steps, than will be applied decay")
     parser.add_argument("--word_dropout", default=0, type=float, help="Word dropout rate")
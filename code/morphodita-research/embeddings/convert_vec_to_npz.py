@@ -1,29 +1,119 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import itertools
+import os
+import sys
+import time
 
 import numpy as np
 
+
+def word_hash(word):
+    # Must be the same as EmbeddingsIndex.hash in embeddings_index.py
+    return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def quantize(embeddings):
+    # Symmetric int8 quantization with a scale for every row
+    scales = np.max(np.abs(embeddings), axis=1) / 127
+    quantized = np.round(embeddings / np.where(scales > 0, scales, 1)[:, np.newaxis]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def save_index(path, words, embeddings, scales=None):
+    # The memory-mapped directory format read by EmbeddingsIndex: the embeddings with a zero
+    # padding row 0 (and their scales if quantized), the encoded words with their offsets,
+    # and the sorted hashes of the words with the rows of these words
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "embeddings.npy"),
+            np.concatenate([np.zeros([1, embeddings.shape[1]], embeddings.dtype), embeddings]))
+    if scales is not None:
+        np.save(os.path.join(path, "scales.npy"), np.concatenate([np.zeros([1], scales.dtype), scales]))
+    encoded = [word.encode("utf-8") for word in words]
+    np.save(os.path.join(path, "words.npy"), np.frombuffer(b"".join(encoded), np.uint8))
+    np.save(os.path.join(path, "word_offsets.npy"), np.cumsum([0] + [len(word) for word in encoded], dtype=np.int64))
+    hashes = np.array([word_hash(word) for word in words], np.uint64)
+    order = np.argsort(hashes, kind="stable")
+    np.save(os.path.join(path, "hashes.npy"), hashes[order])
+    np.save(os.path.join(path, "hash_rows.npy"), (order + 1).astype(np.int32))
+
+
+def corpora_words(corpora):
+    # The forms of the given vertical files, both as they are and lowercased,
+    # because the tagger looks up the lowercased form when the exact one is missing
+    words = set()
+    for corpus in corpora:
+        with open(corpus, "r", encoding="utf-8") as corpus_file:
+            for line in corpus_file:
+                form = line.split("\t", 1)[0].rstrip("\r\n")
+                if form:
+                    words.add(form)
+                    words.add(form.lower())
+    return words
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument("vec_file", type=str, help="Input .vec file path")
-parser.add_argument("npz_file", type=str, help="Output .npz file path")
+parser.add_argument("npz_file", type=str, help="Output .npz file path, or a directory for the memory-mapped format")
+parser.add_argument("--chunk_lines", default=65536, type=int, help="Lines parsed at once")
+parser.add_argument("--corpora", default=None, type=str, help="Comma-separated vertical files, keep only their words")
+parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"],
+                    help="Saved embeddings type, int8 with a scale for every row (only for the directory format)")
 parser.add_argument("--max_words", default=None, type=int, help="Maximum number of words to save")
+parser.add_argument("--max_rank", default=None, type=int, help="Consider only this many most frequent words of the file")
 args = parser.parse_args()
+if args.dtype == "int8" and args.npz_file.endswith(".npz"):
+    parser.error("The int8 embeddings can be saved only in the directory format")
+
+start = time.time()
+kept = corpora_words(args.corpora.split(",")) if args.corpora else None
 
+words, chunks, chunk_scales, read_words, read_chars = [], [], [], 0, 0
 with open(args.vec_file, "r", encoding="utf-8") as vec_file:
     num_words, dim = map(int, vec_file.readline().rstrip().split(" "))
+    if args.max_rank is not None:
+        num_words = min(num_words, args.max_rank)
 
-    if args.max_words is not None:
-        num_words = min(num_words, args.max_words)
+    # The .vec files are sorted by frequency, so reading stops after max_rank lines
+    # or when max_words words are kept
+    while read_words < num_words and (args.max_words is None or len(words) < args.max_words):
+        lines = list(itertools.islice(vec_file, min(args.chunk_lines, num_words - read_words)))
+        if not lines:
+            break
+        read_words += len(lines)
+        read_chars += sum(map(len, lines))
 
-    words = np.empty(num_words, dtype=np.object)
-    embeddings = np.empty((num_words, dim), dtype=np.float32)
+        chunk_words, _, vectors = zip(*(line.partition(" ") for line in lines))
+        if kept is not None or args.max_words is not None:
+            selected = [i for i, word in enumerate(chunk_words) if kept is None or word in kept]
+            if args.max_words is not None:
+                selected = selected[:args.max_words - len(words)]
+            chunk_words, vectors = [chunk_words[i] for i in selected], [vectors[i] for i in selected]
+        if not chunk_words:
+            continue
 
-    for i, line in enumerate(vec_file):
-        if i >= num_words:
-            break
+        # All the numbers of the chunk are parsed by a single call
+        embeddings = np.fromstring(" ".join(vectors), dtype=np.float32, sep=" ")
+        if len(embeddings) != len(chunk_words) * dim:
+            raise ValueError("The vectors of the words {}-{} do not have dimension {}".format(
+                read_words - len(lines) + 1, read_words, dim))
+        embeddings = embeddings.reshape([len(chunk_words), dim])
+
+        if args.dtype == "int8":
+            embeddings, scales = quantize(embeddings)
+            chunk_scales.append(scales)
+        chunks.append(embeddings.astype(args.dtype))
+        words.extend(chunk_words)
 
-        columns = line.rstrip("\n").split(" ")
-        words[i] = columns[0]
-        embeddings[i] = columns[1:1+dim]
+embeddings = np.concatenate(chunks) if chunks else np.zeros([0, dim], args.dtype)
+if args.npz_file.endswith(".npz"):
+    np.savez(args.npz_file, words=np.array(words, dtype=object), embeddings=embeddings)
+else:
+    save_index(args.npz_file, words, embeddings,
+               np.concatenate(chunk_scales + [np.zeros([0], np.float32)]) if args.dtype == "int8" else None)
 
-np.savez(args.npz_file, words=words, embeddings=embeddings)
+elapsed = time.time() - start
+print("Converted {} of {} words with dimension {} as {} in {:.1f}s, {:.0f} words/s, {:.1f}M chars/s".format(
+    len(words), read_words, dim, args.dtype, elapsed, read_words / elapsed, read_chars / elapsed / 1e6),
+    file=sys.stderr)
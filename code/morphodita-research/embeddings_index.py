@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+class EmbeddingsIndex:
+    # Pretrained embeddings in the directory format written by embeddings/convert_vec_to_npz.py.
+    # All arrays are memory-mapped, so that several processes on one host share their pages,
+    # and words are found through their sorted 64-bit hashes instead of a dictionary of all words:
+    # - embeddings.npy: the embedding of the i-th word in row i + 1, row 0 is zero for the padding,
+    #   either float32, float16 or int8 multiplied by the row scales in scales.npy
+    # - words.npy, word_offsets.npy: the UTF-8 encoded words concatenated, and their offsets
+    # - hashes.npy, hash_rows.npy: the sorted hashes of the words, and the rows of these words
+    def __init__(self, path):
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        self.embeddings = load("embeddings")
+        self._scales = load("scales") if os.path.exists(os.path.join(path, "scales.npy")) else None
+        self._words, self._word_offsets = load("words"), load("word_offsets")
+        self._hashes, self._rows = load("hashes"), load("hash_rows")
+
+    # Only the path is pickled (i.e., with the dataset mappings), the arrays are mapped again
+    def __reduce__(self):
+        return EmbeddingsIndex, (self.path,)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __getitem__(self, rows):
+        # The float32 embeddings of the given rows of any shape
+        embeddings = self.embeddings[rows].astype(np.float32)
+        if self._scales is not None:
+            embeddings *= self._scales[rows][..., np.newaxis]
+        return embeddings
+
+    @property
+    def dimension(self):
+        return self.embeddings.shape[1]
+
+    @staticmethod
+    def hash(word):
+        # Must be the same as in embeddings/convert_vec_to_npz.py
+        return int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+
+    def word(self, row):
+        return bytes(self._words[self._word_offsets[row - 1]:self._word_offsets[row]]).decode("utf-8")
+
+    def lookup(self, words):
+        # The embedding rows of the given words, 0 for the missing ones
+        hashes = np.array([self.hash(word) for word in words], np.uint64)
+        positions = np.searchsorted(self._hashes, hashes)
+        rows = np.zeros([len(words)], np.int32)
+        for i in np.flatnonzero(positions < len(self._hashes)):
+            # Distinct words with equal hashes are adjacent, so they are all checked
+            position = positions[i]
+            while position < len(self._hashes) and self._hashes[position] == hashes[i]:
+                if self.word(self._rows[position]) == words[i]:
+                    rows[i] = self._rows[position]
+                    break
+                position += 1
+        return rows
@@ -0,0 +1,82 @@
+import tensorflow as tf
+
+
+class GradientAccumulator:
+    # Sums the gradients of several batches in TF variables, so that the accumulation
+    # never leaves the device. Sparse gradients (tf.IndexedSlices, i.e., of embeddings)
+    # are summed by index into a dense accumulator which also remembers the touched rows,
+    # and are returned again as tf.IndexedSlices of just these rows, so that sparse
+    # optimizers like LazyAdam still update only them.
+    def __init__(self):
+        self._accumulators = None
+        self._touched = None
+        self.steps = 0
+
+    def _build(self, gradients):
+        self._accumulators, self._touched = [], []
+        for g in gradients:
+            if g is None:
+                self._accumulators.append(None)
+                self._touched.append(None)
+                continue
+            shape = g.dense_shape if isinstance(g, tf.IndexedSlices) else g.shape
+            self._accumulators.append(tf.Variable(tf.zeros(shape, g.dtype), trainable=False))
+            self._touched.append(tf.Variable(tf.zeros([shape[0]], tf.bool), trainable=False)
+                                 if isinstance(g, tf.IndexedSlices) else None)
+
+    def accumulate(self, gradients):
+        if self._accumulators is None:
+            self._build(gradients)
+        self._accumulate(gradients)
+        self.steps += 1
+
+    @tf.function(experimental_relax_shapes=True)
+    def _accumulate(self, gradients):
+        for accumulator, touched, g in zip(self._accumulators, self._touched, gradients):
+            if accumulator is None or g is None:
+                continue
+            if isinstance(g, tf.IndexedSlices):
+                accumulator.scatter_add(g)
+                if touched is not None:
+                    touched.scatter_update(tf.IndexedSlices(tf.ones_like(g.indices, tf.bool), g.indices))
+            else:
+                accumulator.assign_add(g)
+                if touched is not None:
+                    touched.assign(tf.ones_like(touched))
+
+    @tf.function
+    def _gradients(self):
+        gradients = []
+        for accumulator, touched in zip(self._accumulators, self._touched):
+            if accumulator is None:
+                gradients.append(None)
+            elif touched is None:
+                gradients.append(accumulator.read_value())
+            else:
+                indices = tf.reshape(tf.where(touched), [-1])
+                gradients.append(tf.IndexedSlices(tf.gather(accumulator, indices), indices,
+                                                  tf.shape(accumulator, out_type=tf.int64)))
+        return gradients
+
+    def gradients(self):
+        # The summed gradients of all batches since the last reset
+        return self._gradients()
+
+    @tf.function
+    def _reset(self):
+        for accumulator, touched in zip(self._accumulators, self._touched):
+            if accumulator is None:
+                continue
+            if touched is None:
+                accumulator.assign(tf.zeros_like(accumulator))
+            else:
+                indices = tf.reshape(tf.where(touched), [-1])
+                accumulator.scatter_update(tf.IndexedSlices(
+                    tf.zeros(tf.concat([tf.shape(indices), tf.shape(accumulator)[1:]], axis=0), accumulator.dtype),
+                    indices))
+                touched.assign(tf.zeros_like(touched))
+
+    def reset(self):
+        if self._accumulators is not None:
+            self._reset()
+        self.steps = 0
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Trains the tagger on the debug `-small` corpora in float32, mixed precision, XLA and
+# mixed precision with XLA, and prints their dev accuracies and training speed side by side.
+import os
+import re
+import subprocess
+import sys
+
+CONFIGURATIONS = [
+    ("float32", []),
+    ("mixed", ["--mixed_precision=1"]),
+    ("xla", ["--jit_compile=1"]),
+    ("mixed+xla", ["--mixed_precision=1", "--jit_compile=1"]),
+]
+
+
+def read_log(path):
+    # The last dev metrics and the training speeds of all epochs
+    metrics, speeds = {}, []
+    with open(path, "r", encoding="utf-8") as log:
+        for line in log:
+            if line.startswith("Dev, "):
+                metrics = {name: float(value) for name, value in re.findall(r"(\w+): ([-0-9.]+)", line.split(", ", 3)[3])}
+            elif line.startswith("Speed, "):
+                speeds.append(float(re.search(r"([0-9.]+) sentences/s", line).group(1)))
+    return metrics, speeds
+
+
+def main(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--configurations", default=",".join(name for name, _ in CONFIGURATIONS), type=str,
+                        help="Configurations to compare.")
+    parser.add_argument("--exp", default="mixed_precision_report", type=str, help="Experiment name prefix.")
+    args, tagger_args = parser.parse_known_args(args)
+
+    # The remaining options (including the input data) are passed to morpho_tagger_2.py
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "morpho_tagger_2.py")
+    results = []
+    for name, options in CONFIGURATIONS:
+        if name not in args.configurations.split(","):
+            continue
+        exp = "{}-{}".format(args.exp, name)
+        print("Training {}".format(name), file=sys.stderr, flush=True)
+        subprocess.run([sys.executable, script, "--debug=1", "--exp={}".format(exp)] + options + tagger_args,
+                       check=True)
+        results.append((name, *read_log("models/{}/log".format(exp))))
+
+    # The first epoch includes the tracing and compilation, so it is reported separately
+    baseline = results[0][1]
+    metric_names = [metric for metric in baseline if metric != "loss"]
+    print("\t".join(["configuration", "first epoch sent/s", "other epochs sent/s"] + metric_names))
+    for name, metrics, speeds in results:
+        columns = [name, "{:.1f}".format(speeds[0]) if speeds else "-",
+                   "{:.1f}".format(sum(speeds[1:]) / len(speeds[1:])) if len(speeds) > 1 else "-"]
+        for metric in metric_names:
+            columns.append("{:.2f} ({:+.2f})".format(metrics[metric], metrics[metric] - baseline[metric])
+                           if metric in metrics else "-")
+        print("\t".join(columns))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,12 +1,20 @@
+import array
 import collections
-import math
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
 import pickle
 import re
+import shutil
 
 import numpy as np
 import os
 import tensorflow as tf
 
+import embeddings_index
+
 
 class MorphoDataset:
     FORMS = 0
@@ -23,14 +31,191 @@ class MorphoDataset:
     PAD = 0
     UNK = 1
 
+    # Bump whenever the layout of the compiled corpus cache changes
+    COMPILED_VERSION = 1
+
+    # Maximum number of (form, lemma) pairs with memoized lemma rules
+    LEMMA_RULE_CACHE = 1 << 19
+
+    # Number of shuffled sentences sorted together when creating length-bucketed batches
+    BUCKET_POOL = 4096
+
+    # BERT embeddings are the mean of this many last layers, stored with the given
+    # dtype in shards of at most BERT_SHARD_ROWS words (only whole sentences)
+    BERT_LAYERS = 4
+    BERT_STORE_DTYPE = np.float32
+    BERT_SHARD_ROWS = 1 << 18
+
+    # Maximum number of padded subwords passed to BERT at once when computing the embeddings
+    BERT_BATCH_TOKENS = 4096
+
+    # Bucketed batches round their padded lengths up to one of BUCKET_STEPS sizes
+    # per power of two, but at least to BUCKET_MIN
+    BUCKET_STEPS = 4
+    BUCKET_MIN = 8
+
+    class _Ragged:
+        # Rows of variable length stored as one flat array and absolute row offsets.
+        def __init__(self, values, offsets):
+            self.values = values
+            self.offsets = offsets
+
+        def __len__(self):
+            return len(self.offsets) - 1
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                start, stop, step = index.indices(len(self))
+                assert step == 1
+                return MorphoDataset._Ragged(self.values, self.offsets[start:max(start, stop) + 1])
+            if index < 0: index += len(self)
+            if not 0 <= index < len(self): raise IndexError(index)
+            return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield self[i]
+
+    class _Sharded:
+        # Rows of several _Ragged shards, indexed as one sequence.
+        def __init__(self, shards):
+            self.shards = shards
+            self._shard = np.repeat(np.arange(len(shards)), [len(shard) for shard in shards])
+            self._index = np.concatenate([np.arange(len(shard)) for shard in shards] or [np.zeros([0], np.int64)])
+
+        def __len__(self):
+            return len(self._shard)
+
+        def __getitem__(self, index):
+            return self.shards[self._shard[index]][self._index[index]]
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield self[i]
+
+    class _Interned:
+        # Sequence of strings stored as ids into a table of unique strings.
+        def __init__(self, strings, ids):
+            self.strings = strings
+            self.ids = ids
+
+        def __len__(self):
+            return len(self.ids)
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self.strings[i] for i in self.ids[index]]
+            return self.strings[self.ids[index]]
+
+    class _LemmaRule:
+        # A lemma rule compiled once into casing operations and either an absolute lemma,
+        # or the insertions and number of form characters removed by the prefix and suffix
+        # edit scripts. Scripts which copy form characters are kept as lists of operations.
+        __slots__ = ["valid", "casing", "lemma", "scripts", "sources"]
+
+        COPY, DELETE = 0, 1
+
+        def __init__(self, lemma_rule):
+            self.valid, self.casing, self.lemma, self.scripts, self.sources = False, [], None, None, None
+            if ";" not in lemma_rule:
+                return
+            casing, rule = lemma_rule.split(";", 1)
+            for case in casing.split("¦"):
+                if case == "↓0": continue  # The lemma is lowercased initially
+                try:
+                    self.casing.append((case[0] == "↑", int(case[1:])))
+                except (IndexError, ValueError):
+                    return
+
+            if rule.startswith("a"):
+                self.lemma = rule[1:]
+            else:
+                rules = rule[1:].split("¦")
+                if len(rules) != 2:
+                    return
+                self.scripts, self.sources = [], []
+                for rule in rules:
+                    operations, source, i = [], 0, 0
+                    while i < len(rule):
+                        if rule[i] == "→" or rule[i] == "-":
+                            operations.append(self.COPY if rule[i] == "→" else self.DELETE)
+                            source += 1
+                        elif rule[i] == "+":
+                            # A dangling insertion makes the rule return the lowercased form
+                            operations.append(rule[i + 1] if i + 1 < len(rule) else None)
+                            i += 1
+                        else:
+                            return
+                        i += 1
+                    if self.COPY not in operations and None not in operations:
+                        operations = "".join(operation for operation in operations if operation != self.DELETE)
+                    self.scripts.append(operations)
+                    self.sources.append(source)
+            self.valid = True
+
+        @staticmethod
+        def _run(script, form, offset):
+            if isinstance(script, str):
+                return script
+            lemma = ""
+            for operation in script:
+                if operation == MorphoDataset._LemmaRule.COPY:
+                    lemma += form[offset]
+                    offset += 1
+                elif operation == MorphoDataset._LemmaRule.DELETE:
+                    offset += 1
+                elif operation is None:
+                    raise IndexError("dangling insertion in a lemma rule")
+                else:
+                    lemma += operation
+            return lemma
+
+        def apply(self, form):
+            if not self.valid:
+                return form
+
+            if self.lemma is not None:
+                lemma = self.lemma
+            else:
+                form = form.lower()
+                try:
+                    end = len(form) - self.sources[1]
+                    lemma = self._run(self.scripts[0], form, 0) + form[self.sources[0]:end] + \
+                            self._run(self.scripts[1], form, end)
+                except IndexError:
+                    lemma = form
+
+            for upper, offset in self.casing:
+                lemma = lemma[:offset] + (lemma[offset:].upper() if upper else lemma[offset:].lower())
+            return lemma
+
     class _Factor:
+        # The tokens of all sentences stored by columns. While loading, the word ids, the ids of
+        # the interned word strings, the charseq ids and the interned analyses (with the offsets of
+        # the analyses of every token) are appended to flat arrays; _flatten_factors then turns
+        # them into _Ragged sentences of numpy arrays, the strings being _Interned in `strings`.
+        __slots__ = ["words_map", "words", "word_ids", "word_strings", "analyses_ids", "analyses_strings",
+                     "strings_map", "strings", "string_ids", "analyses_offsets", "analyses_string_ids",
+                     "characters", "alphabet_map", "alphabet", "charseqs_map", "charseqs", "charseq_ids",
+                     "charseq_strings", "embedding_ids", "lemma_rules"]
+
         def __init__(self, characters, train=None):
             self.words_map = train.words_map if train else {'<pad>': MorphoDataset.PAD, '<unk>': MorphoDataset.UNK}
             self.words = train.words if train else ['<pad>', '<unk>']
-            self.word_ids = []
-            self.word_strings = []
-            self.analyses_ids = []
-            self.analyses_strings = []
+            self.word_ids = array.array("i")
+            self.word_strings = None
+            self.analyses_ids = None
+            self.analyses_strings = None
+            self.strings_map = {}
+            self.strings = []
+            self.string_ids = array.array("i")
+            self.analyses_offsets = array.array("q", [0])
+            self.analyses_string_ids = array.array("i")
+            # The lemma rules compiled by _lemma_rule are shared with the train data, like the words
+            if train and getattr(train, "lemma_rules", None) is None:
+                train.lemma_rules = []
+            self.lemma_rules = train.lemma_rules if train else []
+            self.embedding_ids = None
             self.characters = characters
             if characters:
                 self.alphabet_map = train.alphabet_map if train else {'<pad>': MorphoDataset.PAD,
@@ -38,29 +223,52 @@ class MorphoDataset:
                 self.alphabet = train.alphabet if train else ['<pad>', '<unk>']
                 self.charseqs_map = {'<pad>': MorphoDataset.PAD, '<unk>': MorphoDataset.UNK}
                 self.charseqs = [[MorphoDataset.UNK], [MorphoDataset.UNK]]
-                self.charseq_ids = []
+                self.charseq_ids = array.array("i")
+
+        def intern(self, string):
+            string_id = self.strings_map.get(string)
+            if string_id is None:
+                string_id = self.strings_map[string] = len(self.strings)
+                self.strings.append(string)
+            return string_id
+
+        # Mappings pickled before the factors had slots store a dictionary as well;
+        # the compiled lemma rules are not stored, they are compiled again when needed
+        def __getstate__(self):
+            return {name: getattr(self, name) for name in self.__slots__
+                    if name != "lemma_rules" and hasattr(self, name)}
+
+        def __setstate__(self, state):
+            for name, value in state.items():
+                setattr(self, name, value)
 
     class FactorBatch:
-        def __init__(self, word_ids, charseq_ids=None, charseqs=None, charseq_lens=None, analyses_ids=None):
+        def __init__(self, word_ids, charseq_ids=None, charseqs=None, charseq_lens=None, analyses_ids=None,
+                     analyses_candidates=None, analyses_mask=None):
             self.word_ids = word_ids
             self.charseq_ids = charseq_ids
             self.charseqs = charseqs
             self.charseq_lens = charseq_lens
             self.analyses_ids = analyses_ids
+            self.analyses_candidates = analyses_candidates
+            self.analyses_mask = analyses_mask
 
     def __init__(self, filename, embeddings=None, elmo=None, train=None, lemma_re_strip=None, lemma_rule_min=None,
-                 shuffle_batches=True, max_sentences=None, bert=None, simple=False):
+                 shuffle_batches=True, max_sentences=None, bert=None, simple=False, cache=None, max_tokens=None,
+                 workers=1):
         # Create factors
         self.bert = bert
         self._factors = []
         for f in range(self.FACTORS):
             self._factors.append(self._Factor(f == self.FORMS, train._factors[f] if train else None))
 
-        # Prepare embeddings
+        # Prepare embeddings, either a list of words or an EmbeddingsIndex
         self._embeddings = {}
         # TODO doplnit pro BERTa
         if train:
             self._embeddings = train._embeddings
+        elif isinstance(embeddings, embeddings_index.EmbeddingsIndex):
+            self._embeddings = embeddings
         elif embeddings is not None:
             for i, word in enumerate(embeddings):
                 self._embeddings[word] = i + 1
@@ -69,127 +277,45 @@ class MorphoDataset:
         self._lemma_re_strip = train._lemma_re_strip if train else re.compile(
             lemma_re_strip) if lemma_re_strip else None
 
-        # Load the sentences
-        lemma_rules = collections.defaultdict(lambda: 0)
-        if filename is not None:
-            with open(filename, "r", encoding="utf-8") as file:
-                in_sentence = False
-                for line in file:
-                    line = line.rstrip("\r\n")
-
-                    if line:
-                        form, lemma, tag, *rest = line.split("\t")
-                        assert len(rest) % 2 == 0
-
-                        data = [form, lemma, tag]
-                        analyses = [[], [], []]
-                        if train:
-                            analyses[self.LEMMAS] = [rest[i] for i in range(0, len(rest), 2)]
-                            analyses[self.TAGS] = [rest[i] for i in range(1, len(rest), 2)]
-
-                        for f in range(self.FACTORS):
-                            factor = self._factors[f]
-                            if not in_sentence:
-                                if len(factor.word_ids): factor.word_ids[-1] = np.array(factor.word_ids[-1], np.int32)
-                                factor.word_ids.append([])
-                                factor.word_strings.append([])
-                                factor.analyses_ids.append([])
-                                factor.analyses_strings.append([])
-                                if factor.characters: factor.charseq_ids.append([])
-
-                            word = data[f]
-                            analysis = analyses[f]
-
-                            factor.word_strings[-1].append(word)
-                            factor.analyses_strings[-1].append(analysis)
-                            factor.analyses_ids[-1].append(np.array([1 for _ in analysis], np.int32))
-
-                            # Character-level information
-
-                            # factor.alphabet_map - kazde nove pismenko ma poradove cislo
-                            # factor.charseqs_map - kazde nove slovo ma poradove cislo
-                            # factor.charseqs - slovo reprezentovane cisly jednotlivych pismen
-                            # factor.charseq_ids - text reprezentovany cisly slov
-
-                            # word_ids jsou id tagu (odpovedi) a nebo id slov (v pripade 0)
-                            if factor.characters:
-                                if word not in factor.charseqs_map:
-                                    factor.charseqs_map[word] = len(factor.charseqs)
-                                    factor.charseqs.append([])
-                                    for c in word:
-                                        if c not in factor.alphabet_map:
-                                            if train:
-                                                c = '<unk>'
-                                            else:
-                                                factor.alphabet_map[c] = len(factor.alphabet)
-                                                factor.alphabet.append(c)
-                                        factor.charseqs[-1].append(factor.alphabet_map[c])
-                                factor.charseq_ids[-1].append(factor.charseqs_map[word])
-
-                            # Word-level information
-                            if f == self.LEMMAS:
-                                if self._lemma_re_strip: word = self._lemma_re_strip.sub("", word)
-                                word = self._gen_lemma_rule(data[self.FORMS], word)
-
-                            if f == self.LEMMAS and not train:
-                                factor.word_ids[-1].append(self.UNK)
-                                lemma_rules[word] += 1
-                            else:
-                                if word not in factor.words_map:
-                                    if train:
-                                        word = '<unk>'
-                                    else:
-                                        factor.words_map[word] = len(factor.words)
-                                        factor.words.append(word)
-                                factor.word_ids[-1].append(factor.words_map[word])
-
-                        in_sentence = True
-                    else:
-                        in_sentence = False
-                        if max_sentences is not None and len(self._factors[self.FORMS].word_ids) >= max_sentences:
-                            break
+        # Use the compiled corpus from the cache if it exists
+        compiled_path, compiled = None, False
+        if isinstance(filename, str) and cache is not None:
+            compiled_path = os.path.join(cache, "{}.{}".format(
+                os.path.basename(filename), self._compiled_key(filename, train, lemma_rule_min, max_sentences)))
+            if os.path.exists(os.path.join(compiled_path, "vocabularies.pickle")):
+                self._load_compiled(compiled_path, train)
+                compiled = True
+
+        # Load the sentences, a file given by name possibly in parallel by `workers` processes
+        lemma_rules = None
+        if compiled:
+            pass
+        elif filename is None:
+            self._sentence_lens = np.zeros([0], np.int32)
+        elif isinstance(filename, str) and workers > 1 and max_sentences is None:
+            lemma_rules = self._load_sharded(filename, train, workers)
+        else:
+            # The filename can also be an already opened file or a list of lines
+            with open(filename, "r", encoding="utf-8") if isinstance(filename, str) else \
+                    contextlib.nullcontext(filename) as file:
+                self._load_sentences(file, train, max_sentences)
 
-        # Compute sentence lengths
-        self._sentence_lens = []
-        sentences = len(self._factors[self.FORMS].word_ids)
+        sentences = len(self._sentence_lens)
         if sentences:
-            self._sentence_lens = np.zeros([sentences], np.int32)
-            for i in range(len(self._factors[self.FORMS].word_ids)):
-                self._sentence_lens[i] = len(self._factors[self.FORMS].word_ids[i])
-
-            # Map lemma rules to ids respecting lemma_rule_min for train data
-            if not train:
-                lemmas = self._factors[self.LEMMAS]
-                for i in range(sentences):
-                    for j in range(self._sentence_lens[i]):
-                        word = lemmas.word_strings[i][j]
-                        if self._lemma_re_strip: word = self._lemma_re_strip.sub("", word)
-                        word = self._gen_lemma_rule(self._factors[self.FORMS].word_strings[i][j], word)
-                        if lemma_rules[word] >= (lemma_rule_min or 1):
-                            if word not in lemmas.words_map:
-                                lemmas.words_map[word] = len(lemmas.words)
-                                lemmas.words.append(word)
-                            lemmas.word_ids[i][j] = lemmas.words_map[word]
-
-            # Map analyses
-            # ask analysis?
-            # ask lemma rules?
-            for f in [self.LEMMAS, self.TAGS]:
-                factor = self._factors[f]
-                for i in range(sentences):
-                    for j in range(self._sentence_lens[i]):
-                        for k in range(len(factor.analyses_strings[i][j])):
-                            word = factor.analyses_strings[i][j][k]
-                            if f == self.LEMMAS:
-                                if self._lemma_re_strip: word = re.sub(self._lemma_re_strip, "", word)
-                                word = self._gen_lemma_rule(self._factors[self.FORMS].word_strings[i][j], word)
-                            if word in factor.words_map:
-                                factor.analyses_ids[i][j][k] = factor.words_map[word]
+            self._flatten_factors()
+            if not compiled:
+                self._map_lemmas(train, lemma_rule_min, *(lemma_rules or self._lemma_rules()))
+                if compiled_path is not None:
+                    self._save_compiled(compiled_path)
+            if len(self._embeddings):
+                self._map_embeddings()
 
             # Shuffling initialization
             self._shuffle_batches = shuffle_batches
             self._permutation = np.random.permutation(len(self._sentence_lens)) if self._shuffle_batches else np.arange(
                 len(self._sentence_lens))
+            self._max_tokens = max_tokens
+            self._batch_sizes = None
 
         if bert:
 
@@ -198,81 +324,277 @@ class MorphoDataset:
                 bertname = bert.name
             else:
                 bertname = a[1]
-            bert_file_name = (".").join(filename.split("/")[-1].split(".")[0:-1]) + "." + bertname
-            bert_path = bert_file_name + ".pickle"
+            # The store is keyed by the corpus, the model and the layers, so it is never stale
+            bert_path = os.path.join(cache or ".", "{}.{}.{}".format(
+                os.path.splitext(os.path.basename(filename))[0], bertname,
+                self._bert_key(filename, bert, max_sentences))) if isinstance(filename, str) else None
 
             # if BERT embeddings are precomputed
             self.tokenizer = bert.tokenizer
-            if os.path.exists(bert_path):
-                self.bert_embeddings, self.bert_subwords, self.bert_segments = \
-                    np.load(bert_path, allow_pickle=True)
+            if bert_path is not None and os.path.exists(os.path.join(bert_path, "embedding_shards.npy")):
+                self._load_bert(bert_path)
 
             # else precomputed does not exist, compute here
             else:
-                batch_size_bert = 16
-
-                if "robeczech" in bert.name:
-                    rob = True
-                else:
-                    rob =False
-                sentences_words = self._factors[self.FORMS].word_strings
-                sentences_count = len(sentences_words)
-
+                bert_subwords, bert_segments = self._bert_tokenize(bert)
                 bert_embeddings = []
-                bert_subwords = []
-                bert_segments = []
-                cycle_len = math.ceil(sentences_count / batch_size_bert)
-
-                for i in range(0, cycle_len):
-                    start = i * batch_size_bert
-                    batch_sentences_words = sentences_words[start: min(start + batch_size_bert, sentences_count)]
-
-                    # TODO stahnout novejsi verzi a pouzit batch
-                    # w_subwords = tokenizer.batch_encode_plus(batch_sentences)
-                    for s in batch_sentences_words:
-                        bert_segments.append([])
-                        bert_subwords.append([])
-                        for i_w, w in enumerate(s):
-                            if i_w > 0 and rob:
-                                w = " " + w
-                            w_e = self.tokenizer.encode(w, add_special_tokens=False)
-                            #print("w_E " + str(w_e))
-                            #print("i _w " + str(i_w))
-                            if type(w_e) is dict:
-                                w_e=w_e["input_ids"]
-                            #print(w_e)                                
-                            bert_segments[-1].extend([i_w] * len(w_e))
-                            bert_subwords[-1].extend(w_e)
-
-                        bert_subwords[-1] = np.array(self.tokenizer.build_inputs_with_special_tokens(bert_subwords[-1]),
-                                                     dtype=np.int32)
-                        #print(bert_subwords[-1])
-
-                        bert_segments[-1] = np.array(bert_segments[-1], dtype=np.int32)
-
-                    if bert.embeddings_only and not simple:
-                        w_subwords = bert_subwords[start:]
-
-                        max_len = np.max([len(w) for w in w_subwords])
-                        padded = [np.concatenate((w, [0] * (max_len - len(w)))) for w in w_subwords]
-                        word_tok = tf.convert_to_tensor(np.array(padded, np.int32), tf.int32)
-                        # TODO umi to i udelat padding a vratit tensor!!
-                        # TODO umi vratit i masku
-                        att_mask = np.array(padded) != 0
-
-                        model_output = tf.math.reduce_mean(bert.model(word_tok, attention_mask=att_mask)[2][-4:], axis=0)
-                        for s_i, s in enumerate(batch_sentences_words):
-                            bert_embeddings.append(tf.math.segment_mean(
-                                model_output[s_i][1:len(bert_subwords[start + s_i]) - 1],
-                                bert_segments[start + s_i]).numpy())
-
-                if len(bert_embeddings):
-                    self.save_bert([bert_embeddings, bert_subwords, bert_segments], bert_file_name)
+                if bert.embeddings_only and not simple:
+                    bert_embeddings = self._bert_embed(bert, bert_subwords, bert_segments)
 
                 self.bert_embeddings = bert_embeddings
                 self.bert_segments = bert_segments
                 self.bert_subwords = bert_subwords
 
+                if len(bert_embeddings) and bert_path is not None:
+                    self._save_bert(bert_path, bert_embeddings, bert_subwords, bert_segments)
+                    self._load_bert(bert_path)
+
+    def _load_sentences(self, file, train, max_sentences):
+        sentence_lens = array.array("i")
+        in_sentence = False
+        for line in file:
+            line = line.rstrip("\r\n")
+
+            if line:
+                form, lemma, tag, *rest = line.split("\t")
+                assert len(rest) % 2 == 0
+                if not in_sentence: sentence_lens.append(0)
+                sentence_lens[-1] += 1
+
+                data = [form, lemma, tag]
+                analyses = [[], [], []]
+                if train:
+                    analyses[self.LEMMAS] = rest[0::2]
+                    analyses[self.TAGS] = rest[1::2]
+
+                for f in range(self.FACTORS):
+                    factor = self._factors[f]
+                    word = data[f]
+
+                    factor.string_ids.append(factor.intern(word))
+                    for analysis in analyses[f]:
+                        factor.analyses_string_ids.append(factor.intern(analysis))
+                    factor.analyses_offsets.append(len(factor.analyses_string_ids))
+
+                    # Character-level information
+
+                    # factor.alphabet_map - kazde nove pismenko ma poradove cislo
+                    # factor.charseqs_map - kazde nove slovo ma poradove cislo
+                    # factor.charseqs - slovo reprezentovane cisly jednotlivych pismen
+                    # factor.charseq_ids - text reprezentovany cisly slov
+
+                    # word_ids jsou id tagu (odpovedi) a nebo id slov (v pripade 0)
+                    if factor.characters:
+                        if word not in factor.charseqs_map:
+                            factor.charseqs_map[word] = len(factor.charseqs)
+                            factor.charseqs.append([])
+                            for c in word:
+                                if c not in factor.alphabet_map:
+                                    if train:
+                                        c = '<unk>'
+                                    else:
+                                        factor.alphabet_map[c] = len(factor.alphabet)
+                                        factor.alphabet.append(c)
+                                factor.charseqs[-1].append(factor.alphabet_map[c])
+                        factor.charseq_ids.append(factor.charseqs_map[word])
+
+                    # Word-level information, the lemma rules are mapped in _map_lemmas
+                    if f == self.LEMMAS:
+                        factor.word_ids.append(self.UNK)
+                    else:
+                        if word not in factor.words_map:
+                            if train:
+                                word = '<unk>'
+                            else:
+                                factor.words_map[word] = len(factor.words)
+                                factor.words.append(word)
+                        factor.word_ids.append(factor.words_map[word])
+
+                in_sentence = True
+            else:
+                in_sentence = False
+                if max_sentences is not None and len(sentence_lens) >= max_sentences:
+                    break
+        self._sentence_lens = np.array(sentence_lens, np.int32)
+
+    @staticmethod
+    def _shard_offsets(filename, shards):
+        # Byte offsets splitting the file into at most `shards` parts of similar size, each
+        # starting right after an empty line (or at the beginning of the file)
+        size = os.path.getsize(filename)
+        offsets = [0]
+        with open(filename, "rb") as file:
+            for shard in range(1, shards):
+                file.seek(max(offsets[-1], size * shard // shards))
+                file.readline()
+                for line in iter(file.readline, b""):
+                    if not line.rstrip(b"\r\n"):
+                        break
+                if file.tell() > offsets[-1] and file.tell() < size:
+                    offsets.append(file.tell())
+        return offsets + [size]
+
+    @staticmethod
+    def _load_shard(filename, start, end, train, lemma_re_strip):
+        # Load the sentences of a part of the file with local vocabularies (and strings and
+        # lemma rules), in a worker process of _load_sharded
+        dataset = MorphoDataset.__new__(MorphoDataset)
+        dataset._factors = [MorphoDataset._Factor(f == MorphoDataset.FORMS, train._factors[f] if train else None)
+                            for f in range(MorphoDataset.FACTORS)]
+        dataset._lemma_re_strip = lemma_re_strip
+        with open(filename, "rb") as file:
+            file.seek(start)
+            dataset._load_sentences(io.StringIO(file.read(end - start).decode("utf-8")), train, None)
+        if not len(dataset._sentence_lens):
+            return dataset._sentence_lens, None, None
+        dataset._flatten_factors()
+        return dataset._sentence_lens, dataset._factors, dataset._lemma_rules()
+
+    def _load_sharded(self, filename, train, workers):
+        # Load the file split at sentence boundaries by parallel workers and merge their results
+        # in the file order, remapping the local ids so that all vocabularies, strings and ids are
+        # the same as when loading the file at once. Returns the merged lemma rules.
+        offsets = self._shard_offsets(filename, workers)
+        mappings = MorphoDataset(None, train=train) if train else None
+        with concurrent.futures.ProcessPoolExecutor(min(workers, len(offsets) - 1)) as pool:
+            shards = [shard for shard in pool.map(
+                self._load_shard, *zip(*[(filename, start, end, mappings, self._lemma_re_strip)
+                                         for start, end in zip(offsets[:-1], offsets[1:])])) if shard[1] is not None]
+
+        self._sentence_lens = np.concatenate([sentence_lens for sentence_lens, _, _ in shards] or
+                                             [np.zeros([0], np.int32)])
+        for f, factor in enumerate(self._factors):
+            word_ids, string_ids, analyses_lens, analyses_string_ids, charseq_ids = [], [], [], [], []
+            for _, factors, _ in shards:
+                local = factors[f]
+                strings = np.array([factor.intern(string) for string in local.strings], np.int32)
+                for word in local.words:
+                    if word not in factor.words_map:
+                        factor.words_map[word] = len(factor.words)
+                        factor.words.append(word)
+                words = np.array([factor.words_map[word] for word in local.words], np.int32)
+                word_ids.append(words[local.word_ids.values])
+                string_ids.append(strings[local.word_strings.values.ids])
+                analyses_lens.append(np.diff(local.analyses_ids.values.offsets))
+                analyses_string_ids.append(strings[local.analyses_strings.values.values.ids])
+                if factor.characters:
+                    for c in local.alphabet:
+                        if c not in factor.alphabet_map:
+                            factor.alphabet_map[c] = len(factor.alphabet)
+                            factor.alphabet.append(c)
+                    alphabet = np.array([factor.alphabet_map[c] for c in local.alphabet], np.int32)
+                    charseqs = np.zeros([len(local.charseq_strings)], np.int32)
+                    for i, word in enumerate(local.charseq_strings):
+                        if word not in factor.charseqs_map:
+                            factor.charseqs_map[word] = len(factor.charseqs)
+                            factor.charseqs.append(alphabet[local.charseqs[i]])
+                        charseqs[i] = factor.charseqs_map[word]
+                    charseq_ids.append(charseqs[local.charseq_ids.values])
+            factor.word_ids = np.concatenate(word_ids)
+            factor.string_ids = np.concatenate(string_ids)
+            factor.analyses_offsets = np.concatenate([[0], np.cumsum(np.concatenate(analyses_lens))])
+            factor.analyses_string_ids = np.concatenate(analyses_string_ids)
+            if factor.characters:
+                factor.charseq_ids = np.concatenate(charseq_ids)
+
+        rules, rules_map, lemma_rule_ids, analysis_rule_ids = [], {}, [], []
+        for _, _, (shard_rules, lemma_ids, analysis_ids) in shards:
+            remap = np.zeros([len(shard_rules)], np.int32)
+            for i, rule in enumerate(shard_rules):
+                if rule not in rules_map:
+                    rules_map[rule] = len(rules)
+                    rules.append(rule)
+                remap[i] = rules_map[rule]
+            lemma_rule_ids.append(remap[lemma_ids])
+            analysis_rule_ids.append(remap[analysis_ids])
+        return rules, np.concatenate(lemma_rule_ids), np.concatenate(analysis_rule_ids)
+
+    def _bert_tokenize(self, bert):
+        # Tokenize all words of the corpus in one call, the words of a sentence after
+        # the first one preceded by a space for RobeCzech, and then assemble the sentences
+        rob = "robeczech" in bert.name
+        sentences = self._factors[self.FORMS].word_strings
+        words = [" " + word if i_w > 0 and rob else word for s in sentences for i_w, word in enumerate(s)]
+        encoded = self.tokenizer.batch_encode_plus(words, add_special_tokens=False)["input_ids"] if words else []
+        encoded_lens = np.array([len(w_e) for w_e in encoded], np.int64)
+
+        bert_subwords, bert_segments, start = [], [], 0
+        for s in sentences:
+            end = start + len(s)
+            bert_subwords.append(np.array(self.tokenizer.build_inputs_with_special_tokens(
+                [subword for w_e in encoded[start:end] for subword in w_e]), dtype=np.int32))
+            bert_segments.append(np.repeat(np.arange(len(s), dtype=np.int32), encoded_lens[start:end]))
+            start = end
+        return bert_subwords, bert_segments
+
+    @staticmethod
+    def _bert_windows(subwords, inner_len, window, overlap):
+        # Split a sentence longer than `window` subwords into windows of its inner subwords,
+        # consecutive ones overlapping by `overlap`, each wrapped in the special tokens of the
+        # sentence. Every inner subword is later taken from the window where it is farther
+        # from the window boundary. Returns the windows and the kept positions in them.
+        if len(subwords) <= window:
+            return [subwords], [np.arange(1, 1 + inner_len)]
+        prefix, inner, suffix = subwords[:1], subwords[1:1 + inner_len], subwords[1 + inner_len:]
+        frame_len = window - len(prefix) - len(suffix)
+        step = frame_len - overlap
+        assert step > 0, "The BERT window overlap must be smaller than the window"
+
+        frames = 1 + (inner_len - frame_len + step - 1) // step
+        windows, kept = [], []
+        for f in range(frames):
+            start = f * step
+            lo = start + overlap // 2 if f else 0
+            hi = (f + 1) * step + overlap // 2 if f + 1 < frames else inner_len
+            windows.append(np.concatenate([prefix, inner[start:start + frame_len], suffix]))
+            kept.append(1 + lo - start + np.arange(hi - lo))
+        return windows, kept
+
+    def _bert_embed(self, bert, bert_subwords, bert_segments):
+        # Run the model on sentences sorted by subword length, in batches of at most
+        # BERT_BATCH_TOKENS padded subwords, and pool the words of a whole batch at once.
+        # Sentences longer than bert.window are encoded in overlapping windows.
+        lengths = np.array([len(subwords) for subwords in bert_subwords], np.int64)
+        word_lens = np.array([segments[-1] + 1 if len(segments) else 0 for segments in bert_segments], np.int64)
+        pad = self.tokenizer.pad_token_id or 0
+
+        bert_embeddings = [None] * len(bert_subwords)
+        order = np.argsort(lengths, kind="stable")
+        start = 0
+        while start < len(order):
+            batch, windows, kept = [], [], []
+            while start < len(order):
+                i = order[start]
+                sentence_windows, sentence_kept = self._bert_windows(
+                    bert_subwords[i], len(bert_segments[i]), bert.window, bert.window_overlap)
+                if batch and (len(windows) + len(sentence_windows)) * min(lengths[i], bert.window) > \
+                        self.BERT_BATCH_TOKENS:
+                    break
+                batch.append(i)
+                windows.extend(sentence_windows)
+                kept.extend(sentence_kept)
+                start += 1
+
+            window_lens = np.array([len(window) for window in windows], np.int64)
+            max_len = np.max(window_lens)
+            mask = np.arange(max_len)[np.newaxis, :] < window_lens[:, np.newaxis]
+            subwords = np.full(mask.shape, pad, np.int32)
+            subwords[mask] = np.concatenate(windows)
+            model_output = tf.math.reduce_mean(bert.model(
+                tf.convert_to_tensor(subwords, tf.int32), attention_mask=tf.convert_to_tensor(mask, tf.int32)
+            )[2][-self.BERT_LAYERS:], axis=0)
+
+            # Average the kept subwords of every word, which skip the special tokens
+            word_offsets = np.concatenate([[0], np.cumsum(word_lens[batch])])
+            positions = np.concatenate([w * max_len + window_kept for w, window_kept in enumerate(kept)])
+            segments = np.concatenate([bert_segments[i] + word_offsets[b] for b, i in enumerate(batch)])
+            pooled = tf.math.unsorted_segment_mean(
+                tf.gather(tf.reshape(model_output, [-1, model_output.shape[-1]]), positions),
+                segments, word_offsets[-1]).numpy()
+            for b, i in enumerate(batch):
+                bert_embeddings[i] = pooled[word_offsets[b]:word_offsets[b + 1]]
+        return bert_embeddings
+
     @property
     def sentence_lens(self):
         return self._sentence_lens
@@ -289,89 +611,463 @@ class MorphoDataset:
         with open(path, mode="wb") as mappings_file:
             pickle.dump(MorphoDataset(None, train=self), mappings_file)
 
-    def save_bert(self, embeddings, file):
-        for_save = embeddings
-        with open(file + '.pickle', 'wb') as handle:
-            pickle.dump(for_save, handle)
-
     @staticmethod
     def load_mappings(path):
         with open(path, mode="rb") as mappings_file:
             return pickle.load(mappings_file)
 
+    @staticmethod
+    def _hash_file(key, filename):
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                key.update(chunk)
+
+    def _compiled_key(self, filename, train, lemma_rule_min, max_sentences):
+        key = hashlib.sha1()
+        self._hash_file(key, filename)
+        key.update(repr((self.COMPILED_VERSION, self._lemma_re_strip.pattern if self._lemma_re_strip else None,
+                         lemma_rule_min, max_sentences)).encode("utf-8"))
+        # Ids of dev/test data depend on the vocabularies of the train data
+        if train:
+            for factor in train._factors:
+                key.update("\n".join(factor.words).encode("utf-8"))
+                if factor.characters: key.update("\n".join(factor.alphabet).encode("utf-8"))
+        return key.hexdigest()
+
+    def _save_compiled(self, path):
+        # The columns are stored as they are, see _flatten_factors
+        arrays = {"sentence_lens": np.asarray(self._sentence_lens, np.int32)}
+        vocabularies = []
+        for f, factor in enumerate(self._factors):
+            arrays["word_ids.{}".format(f)] = factor.word_ids.values
+            arrays["string_ids.{}".format(f)] = factor.word_strings.values.ids
+            arrays["analyses_ids.{}".format(f)] = factor.analyses_ids.values.values
+            arrays["analyses_string_ids.{}".format(f)] = factor.analyses_strings.values.values.ids
+            arrays["analyses_offsets.{}".format(f)] = factor.analyses_ids.values.offsets
+            vocabulary = {"words": factor.words, "strings": factor.strings}
+            if factor.characters:
+                arrays["charseq_ids.{}".format(f)] = factor.charseq_ids.values
+                arrays["charseqs.{}".format(f)] = factor.charseqs.values
+                arrays["charseq_offsets.{}".format(f)] = factor.charseqs.offsets
+                vocabulary["alphabet"] = factor.alphabet
+                vocabulary["charseqs"] = factor.charseq_strings
+            vocabularies.append(vocabulary)
+
+        self._save_arrays(path, arrays, vocabularies)
+
+    @staticmethod
+    def _save_arrays(path, arrays, vocabularies=None):
+        # Write to a temporary directory and rename it, so that concurrent runs never see partial caches
+        partial_path = "{}.{}.partial".format(path, os.getpid())
+        os.makedirs(partial_path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(partial_path, name + ".npy"), array)
+        if vocabularies is not None:
+            with open(os.path.join(partial_path, "vocabularies.pickle"), mode="wb") as vocabularies_file:
+                pickle.dump(vocabularies, vocabularies_file, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(partial_path, path)
+        except OSError:
+            shutil.rmtree(partial_path, ignore_errors=True)
+
+    def _load_compiled(self, path, train):
+        def load(name, f=None):
+            return np.load(os.path.join(path, (name if f is None else "{}.{}".format(name, f)) + ".npy"), mmap_mode="r")
+
+        with open(os.path.join(path, "vocabularies.pickle"), mode="rb") as vocabularies_file:
+            vocabularies = pickle.load(vocabularies_file)
+
+        self._sentence_lens = np.array(load("sentence_lens"))
+        sentence_offsets = np.concatenate([[0], np.cumsum(self._sentence_lens, dtype=np.int64)])
+        for f, factor in enumerate(self._factors):
+            vocabulary = vocabularies[f]
+            if not train:
+                factor.words = vocabulary["words"]
+                factor.words_map = {word: i for i, word in enumerate(factor.words)}
+            factor.strings = vocabulary["strings"]
+            factor.word_ids = self._Ragged(load("word_ids", f), sentence_offsets)
+            factor.word_strings = self._Ragged(
+                self._Interned(vocabulary["strings"], load("string_ids", f)), sentence_offsets)
+            analyses_offsets = load("analyses_offsets", f)
+            factor.analyses_ids = self._Ragged(
+                self._Ragged(load("analyses_ids", f), analyses_offsets), sentence_offsets)
+            factor.analyses_strings = self._Ragged(self._Ragged(
+                self._Interned(vocabulary["strings"], load("analyses_string_ids", f)), analyses_offsets),
+                sentence_offsets)
+            if factor.characters:
+                if not train:
+                    factor.alphabet = vocabulary["alphabet"]
+                    factor.alphabet_map = {c: i for i, c in enumerate(factor.alphabet)}
+                factor.charseqs_map = {charseq: i for i, charseq in enumerate(vocabulary["charseqs"])}
+                factor.charseqs = self._Ragged(load("charseqs", f), load("charseq_offsets", f))
+                factor.charseq_ids = self._Ragged(load("charseq_ids", f), sentence_offsets)
+
+    def _bert_key(self, filename, bert, max_sentences):
+        key = hashlib.sha1()
+        self._hash_file(key, filename)
+        key.update(repr((self.COMPILED_VERSION, bert.name, self.BERT_LAYERS, np.dtype(self.BERT_STORE_DTYPE).str,
+                         bert.window, bert.window_overlap, max_sentences)).encode("utf-8"))
+        return key.hexdigest()
+
+    def _save_bert(self, path, embeddings, subwords, segments):
+        def offsets(rows):
+            return np.cumsum([0] + [len(row) for row in rows], dtype=np.int64)
+
+        arrays = {"subwords": np.concatenate(subwords).astype(np.int32), "subword_offsets": offsets(subwords),
+                  "segments": np.concatenate(segments).astype(np.int32), "segment_offsets": offsets(segments)}
+
+        # Split the embeddings into shards of whole sentences
+        shards, rows = [[]], 0
+        for sentence in embeddings:
+            if shards[-1] and rows + len(sentence) > self.BERT_SHARD_ROWS:
+                shards.append([])
+                rows = 0
+            shards[-1].append(sentence)
+            rows += len(sentence)
+        for s, shard in enumerate(shards):
+            arrays["embeddings.{}".format(s)] = np.concatenate(shard).astype(self.BERT_STORE_DTYPE)
+            arrays["embedding_offsets.{}".format(s)] = offsets(shard)
+        arrays["embedding_shards"] = np.array([len(shard) for shard in shards], np.int64)
+        self._save_arrays(path, arrays)
+
+    def _load_bert(self, path):
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+
+        self.bert_subwords = self._Ragged(load("subwords"), load("subword_offsets"))
+        self.bert_segments = self._Ragged(load("segments"), load("segment_offsets"))
+        self.bert_embeddings = self._Sharded([
+            self._Ragged(load("embeddings.{}".format(s)), load("embedding_offsets.{}".format(s)))
+            for s in range(len(load("embedding_shards")))])
+
+    @staticmethod
+    def read_sentences(file, max_sentences):
+        # Read the file incrementally, yielding lines of at most `max_sentences` sentences at a time
+        lines, sentences, in_sentence = [], 0, False
+        for line in file:
+            if line.rstrip("\r\n"):
+                lines.append(line)
+                in_sentence = True
+            elif in_sentence:
+                lines.append(line)
+                in_sentence = False
+                sentences += 1
+                if sentences >= max_sentences:
+                    yield lines
+                    lines, sentences = [], 0
+        if lines:
+            yield lines
+
     def epoch_finished(self):
         if len(self._permutation) == 0:
             self._permutation = np.random.permutation(len(self._sentence_lens)) if self._shuffle_batches else np.arange(
                 len(self._sentence_lens))
+            self._batch_sizes = None
             return True
         return False
 
+    def get_state(self):
+        # The remaining sentences of the epoch and the numpy random state, which
+        # together determine all the following batches
+        return {"permutation": self._permutation, "random": np.random.get_state(),
+                "batch_sizes": list(self._batch_sizes) if self._batch_sizes is not None else None}
+
+    def set_state(self, state):
+        self._permutation = state["permutation"]
+        self._batch_sizes = list(state["batch_sizes"]) if state["batch_sizes"] is not None else None
+        np.random.set_state(state["random"])
+
+    def _plan_batches(self):
+        # Split the epoch into batches of at most `max_tokens` padded tokens. Shuffled
+        # data are sorted by length inside pools of BUCKET_POOL sentences and the
+        # batches are then shuffled; otherwise the file order is kept exactly.
+        lengths = self._sentence_lens
+        if self.bert:
+            lengths = np.maximum(lengths, [len(subwords) for subwords in self.bert_subwords])
+
+        permutation = self._permutation
+        if self._shuffle_batches:
+            permutation = np.concatenate([
+                pool[np.argsort(lengths[pool], kind="stable")]
+                for pool in np.split(permutation, range(self.BUCKET_POOL, len(permutation), self.BUCKET_POOL))])
+
+        batch_sizes, size, max_length = [], 0, 0
+        for length in lengths[permutation]:
+            if size and (size + 1) * max(max_length, length) > self._max_tokens:
+                batch_sizes.append(size)
+                size, max_length = 0, 0
+            size, max_length = size + 1, max(max_length, length)
+        if size: batch_sizes.append(size)
+
+        if self._shuffle_batches:
+            batches = np.split(permutation, np.cumsum(batch_sizes)[:-1])
+            order = np.random.permutation(len(batches))
+            permutation = np.concatenate([batches[i] for i in order])
+            batch_sizes = [batch_sizes[i] for i in order]
+
+        self._permutation = permutation
+        self._batch_sizes = batch_sizes
+
+    def _flatten_factors(self):
+        # Keep the loaded columns as flat numpy arrays with sentence offsets, so that
+        # batches can be gathered with fancy indexing instead of Python loops
+        self._sentence_offsets = np.concatenate([[0], np.cumsum(self._sentence_lens, dtype=np.int64)])
+        for factor in self._factors:
+            if not isinstance(factor.word_ids, self._Ragged):
+                analyses_offsets = np.array(factor.analyses_offsets, np.int64)
+                analyses_string_ids = np.array(factor.analyses_string_ids, np.int32)
+                factor.word_ids = self._Ragged(np.array(factor.word_ids, np.int32), self._sentence_offsets)
+                factor.word_strings = self._Ragged(
+                    self._Interned(factor.strings, np.array(factor.string_ids, np.int32)), self._sentence_offsets)
+                factor.analyses_ids = self._Ragged(self._Ragged(
+                    np.full(len(analyses_string_ids), self.UNK, np.int32), analyses_offsets), self._sentence_offsets)
+                factor.analyses_strings = self._Ragged(self._Ragged(
+                    self._Interned(factor.strings, analyses_string_ids), analyses_offsets), self._sentence_offsets)
+                factor.strings_map = factor.string_ids = factor.analyses_offsets = factor.analyses_string_ids = None
+            if factor.characters:
+                if not isinstance(factor.charseq_ids, self._Ragged):
+                    factor.charseq_ids = self._Ragged(np.array(factor.charseq_ids, np.int32), self._sentence_offsets)
+                if not isinstance(factor.charseqs, self._Ragged):
+                    factor.charseqs = self._Ragged(
+                        np.array([c for charseq in factor.charseqs for c in charseq], np.int32),
+                        np.cumsum([0] + [len(charseq) for charseq in factor.charseqs], dtype=np.int64))
+                factor.charseq_strings = list(factor.charseqs_map)
+
+    def _map_embeddings(self):
+        # The embedding ids of all forms as a column next to the form ids, resolved once per
+        # distinct form, either exactly or lowercased (0 for forms without embeddings)
+        forms = self._factors[self.FORMS]
+        exact = self._lookup_embeddings(forms.charseq_strings)
+        lowercased = self._lookup_embeddings([string.lower() for string in forms.charseq_strings])
+        charseq_ids = forms.charseq_ids.values
+        forms.embedding_ids = self._Ragged(np.where(exact, exact, lowercased)[charseq_ids], self._sentence_offsets)
+
+        # Token counts of exactly found, lowercased found and missing forms
+        found_exact = np.count_nonzero(exact[charseq_ids])
+        found_lowercased = np.count_nonzero(forms.embedding_ids.values) - found_exact
+        self._embeddings_stats = (found_exact, found_lowercased, len(charseq_ids) - found_exact - found_lowercased)
+
+    def _lookup_embeddings(self, words):
+        if isinstance(self._embeddings, embeddings_index.EmbeddingsIndex):
+            return self._embeddings.lookup(words)
+        return np.array([self._embeddings.get(word, 0) for word in words], np.int32)
+
+    def embeddings_info(self):
+        exact, lowercased, oov = getattr(self, "_embeddings_stats", (0, 0, 0))
+        return "Embeddings: {} tokens, {:.2f}% exact, {:.2f}% lowercased, {:.2f}% OOV".format(
+            exact + lowercased + oov, *(100 * count / max(1, exact + lowercased + oov)
+                                        for count in [exact, lowercased, oov]))
+
+    def _lemma_rules(self):
+        # The distinct lemma rules in the order of their first occurrence, and the rule ids
+        # of all lemmas and of all lemma analyses (which use the form of their token).
+        # Every rule is generated just once per distinct (form, lemma) pair.
+        forms, lemmas = self._factors[self.FORMS], self._factors[self.LEMMAS]
+        rules, rules_map = [], {}
+
+        def rule_ids(form_ids, lemma_ids):
+            pairs, first, inverse = np.unique(form_ids.astype(np.int64) * len(lemmas.strings) + lemma_ids,
+                                              return_index=True, return_inverse=True)
+            pair_rules = np.zeros([len(pairs)], np.int32)
+            for i in np.argsort(first, kind="stable"):
+                lemma = lemmas.strings[pairs[i] % len(lemmas.strings)]
+                if self._lemma_re_strip: lemma = self._lemma_re_strip.sub("", lemma)
+                rule = self._gen_lemma_rule(forms.strings[pairs[i] // len(lemmas.strings)], lemma)
+                if rule not in rules_map:
+                    rules_map[rule] = len(rules)
+                    rules.append(rule)
+                pair_rules[i] = rules_map[rule]
+            return pair_rules[inverse.reshape(-1)]
+
+        analyses = lemmas.analyses_strings.values
+        return rules, rule_ids(forms.word_strings.values.ids, lemmas.word_strings.values.ids), rule_ids(
+            np.repeat(forms.word_strings.values.ids, np.diff(analyses.offsets)), analyses.values.ids)
+
+    def _map_lemmas(self, train, lemma_rule_min, rules, lemma_rule_ids, analysis_rule_ids):
+        # Map the lemmas and the analyses to ids, given the lemma rules from _lemma_rules. The train
+        # data keep the rules occurring at least lemma_rule_min times, numbered in the order of
+        # their first occurrence.
+        lemmas, tags = self._factors[self.LEMMAS], self._factors[self.TAGS]
+        if not train:
+            for rule, count in zip(rules, np.bincount(lemma_rule_ids, minlength=len(rules))):
+                if count >= (lemma_rule_min or 1) and rule not in lemmas.words_map:
+                    lemmas.words_map[rule] = len(lemmas.words)
+                    lemmas.words.append(rule)
+        rule_ids = np.array([lemmas.words_map.get(rule, self.UNK) for rule in rules], np.int32)
+        lemmas.word_ids.values[:] = rule_ids[lemma_rule_ids]
+        lemmas.analyses_ids.values.values[:] = rule_ids[analysis_rule_ids]
+        tags.analyses_ids.values.values[:] = np.array(
+            [tags.words_map.get(string, self.UNK) for string in tags.strings], np.int32)[
+            tags.analyses_strings.values.values.ids]
+
+    @staticmethod
+    def _ragged_indices(ragged, rows, width=None):
+        # Positions of the given rows of a flat offset-indexed array in a padded [len(rows), width] matrix
+        starts = ragged.offsets[rows]
+        lens = ragged.offsets[rows + 1] - starts
+        columns = np.arange(np.max(lens, initial=0) if width is None else width)
+        mask = columns[np.newaxis, :] < lens[:, np.newaxis]
+        return mask, (starts[:, np.newaxis] + columns[np.newaxis, :])[mask]
+
+    @staticmethod
+    def _gather_ragged(ragged, rows, width=None):
+        mask, indices = MorphoDataset._ragged_indices(ragged, rows, width)
+        result = np.zeros(mask.shape, np.int32)
+        result[mask] = ragged.values[indices]
+        return result, mask
+
     def next_batch(self, batch_size):
+        if self._max_tokens:
+            if self._batch_sizes is None:
+                self._plan_batches()
+            batch_size = min(batch_size, self._batch_sizes[0])
+            self._batch_sizes[0] -= batch_size
+            if not self._batch_sizes[0]: self._batch_sizes.pop(0)
         batch_size = min(batch_size, len(self._permutation))
         batch_perm = self._permutation[:batch_size]
         self._permutation = self._permutation[batch_size:]
+        return self._batch(batch_perm)
+
+    def epoch_batches(self, batch_size):
+        # The sentences of all remaining batches of the epoch, which is finished afterwards
+        batches = []
+        while not self.epoch_finished():
+            if self._max_tokens:
+                if self._batch_sizes is None:
+                    self._plan_batches()
+                size = min(batch_size, self._batch_sizes[0])
+                self._batch_sizes[0] -= size
+                if not self._batch_sizes[0]: self._batch_sizes.pop(0)
+            else:
+                size = batch_size
+            batches.append(self._permutation[:size])
+            self._permutation = self._permutation[size:]
+        return batches
+
+    def tf_dataset(self, batch_size, inputs, buckets=False, shards=1, shard=0, replicas=1, skip=0):
+        # The remaining batches of the epoch as a tf.data.Dataset. The batches are created in
+        # parallel (but kept in order) and prefetched, `inputs(sentence_lens, factors)` converting
+        # every batch into a list of arrays. All dimensions are variable except for the
+        # embedding size of floating point arrays, so that the signature never changes.
+        # With `buckets`, the padded lengths of the batches are bucketed, see _batch.
+        # With `shards`, only every shards-th batch starting with `shard` is kept; the batches
+        # are first padded by empty ones so that every shard gets the same number of them,
+        # divisible by `replicas`. The first `skip` batches of the shard are left out.
+        batches = self.epoch_batches(batch_size)
+        if not batches:
+            return tf.data.Dataset.range(0)
+        batches += [batches[0][:0]] * (-len(batches) % (shards * replicas))
+        batches = batches[shard::shards][skip:]
+        if not batches:
+            return tf.data.Dataset.range(0)
+        sample = inputs(*self._batch(batches[0], buckets))
+        types = [tf.as_dtype(array.dtype) for array in sample]
+        shapes = [[None] * (array.ndim - 1) + [array.shape[-1] if types[i].is_floating and array.ndim > 2 else None]
+                  for i, array in enumerate(sample)]
+
+        def create(index):
+            arrays = tf.numpy_function(lambda index: inputs(*self._batch(batches[index], buckets)), [index], types)
+            for array, shape in zip(arrays, shapes):
+                array.set_shape(shape)
+            return tuple(arrays)
+
+        # The parallel map keeps the order of the batches by default (its deterministic
+        # argument exists only since TF 2.2)
+        return tf.data.Dataset.range(len(batches)).map(
+            create, num_parallel_calls=tf.data.experimental.AUTOTUNE).prefetch(tf.data.experimental.AUTOTUNE)
+
+    @classmethod
+    def _bucket(cls, length):
+        # The smallest bucket size not less than length
+        length = max(int(length), cls.BUCKET_MIN)
+        step = max(1, (1 << (length - 1).bit_length()) // (2 * cls.BUCKET_STEPS))
+        return -(-length // step) * step
+
+    def _batch(self, batch_perm, buckets=False):
+        # With `buckets`, the sentences, charseqs and subwords are padded to bucketed lengths
+        # (the number of sentences and the sentence lengths stay exact), so that the batches
+        # have only a bounded number of distinct shapes
+        batch_size = len(batch_perm)
 
         # General data
         batch_sentence_lens = self._sentence_lens[batch_perm]
-        max_sentence_len = np.max(batch_sentence_lens)
+        max_sentence_len = np.max(batch_sentence_lens, initial=0)
+        if buckets: max_sentence_len = self._bucket(max_sentence_len)
 
         # Word-level data
         factors = []
         for factor in self._factors:
-            factors.append(self.FactorBatch(np.zeros([batch_size, max_sentence_len], np.int32)))
-            for i in range(batch_size):
-                factors[-1].word_ids[i, 0:batch_sentence_lens[i]] = factor.word_ids[batch_perm[i]]
+            word_ids, mask = self._gather_ragged(factor.word_ids, batch_perm, width=max_sentence_len)
+            factors.append(self.FactorBatch(word_ids))
 
-        # Embeddings
+        # Character-level data, with the charseqs renumbered in the order of their first occurrence in the batch
         forms = self._factors[self.FORMS]
-        factors.append(self.FactorBatch(np.zeros([batch_size, max_sentence_len], np.int32)))
+        for f, factor in enumerate(self._factors):
+            if not factor.characters: continue
+
+            _, indices = self._ragged_indices(factor.charseq_ids, batch_perm, width=max_sentence_len)
+            charseq_ids = factor.charseq_ids.values[indices]
+            unique, first, inverse = np.unique(charseq_ids, return_index=True, return_inverse=True)
+            order = np.argsort(first, kind="stable")
+            ranks = np.empty_like(order)
+            ranks[order] = np.arange(len(order))
+
+            factors[f].charseq_ids = np.zeros([batch_size, max_sentence_len], np.int32)
+            factors[f].charseq_ids[mask] = ranks[inverse.reshape(-1)]
+            factors[f].charseqs, _ = self._gather_ragged(factor.charseqs, unique[order])
+            factors[f].charseq_lens = (factor.charseqs.offsets[unique[order] + 1] -
+                                       factor.charseqs.offsets[unique[order]]).astype(np.int32)
+            if buckets:
+                # The added charseqs are never referenced, but are nonempty (a single UNK)
+                charseqs, lens = factors[f].charseqs, factors[f].charseq_lens
+                factors[f].charseqs = np.zeros([self._bucket(len(charseqs)), self._bucket(charseqs.shape[1])], np.int32)
+                factors[f].charseqs[:len(charseqs), :charseqs.shape[1]] = charseqs
+                factors[f].charseqs[len(charseqs):, 0] = self.UNK
+                factors[f].charseq_lens = np.ones([len(factors[f].charseqs)], np.int32)
+                factors[f].charseq_lens[:len(lens)] = lens
+
+        # Embeddings, looked up when loading, see _map_embeddings
         if len(self._embeddings):
-            for i in range(batch_size):
-                for j, string in enumerate(forms.word_strings[batch_perm[i]]):
-                    mapped = self._embeddings.get(string, 0)
-                    if not mapped: mapped = self._embeddings.get(string.lower(), 0)
-                    factors[-1].word_ids[i, j] = mapped
+            factors.append(self.FactorBatch(self._gather_ragged(forms.embedding_ids, batch_perm, width=max_sentence_len)[0]))
+        else:
+            factors.append(self.FactorBatch(np.zeros([batch_size, max_sentence_len], np.int32)))
 
         # BERT
-        factors.append(self.FactorBatch(np.zeros([batch_size, max_sentence_len, 768], np.float)))
+        factors.append(self.FactorBatch(np.zeros([batch_size, max_sentence_len, 768], np.float32)))
         if self.bert and self.bert.embeddings_only:
-            for i in range(batch_size):
-                factors[-1].word_ids[i, :len(self.bert_embeddings[batch_perm[i]])] = self.bert_embeddings[batch_perm[i]]
+            # Copy the rows from the (memory-mapped) store right into the batch
+            for b, i in enumerate(batch_perm):
+                sentence = self.bert_embeddings[i]
+                factors[-1].word_ids[b, :len(sentence)] = sentence
 
         if self.bert:
-            max_subwords = max(len(self.bert_subwords[i]) for i in batch_perm)
+            subword_lens = np.array([len(self.bert_subwords[i]) for i in batch_perm], np.int64)
+            segment_lens = np.array([len(self.bert_segments[i]) for i in batch_perm], np.int64)
+            max_subwords = np.max(subword_lens, initial=1)
+            # Keep at least one padding subword, mapped to the padding segment max_sentence_len
+            if buckets: max_subwords = self._bucket(max_subwords + 1)
             factors.append(self.FactorBatch(np.zeros([batch_size, max_subwords], np.int32)))
             factors.append(self.FactorBatch(
                 np.full([batch_size, max_subwords - 1], max_sentence_len, np.int32)))  # because first token is deleted
-            for i in range(batch_size):
-                factors[-2].word_ids[i, :len(self.bert_subwords[batch_perm[i]])] = self.bert_subwords[batch_perm[i]]
-                factors[-1].word_ids[i, :len(self.bert_segments[batch_perm[i]])] = self.bert_segments[batch_perm[i]]
-
-        # Character-level data
-        for f, factor in enumerate(self._factors):
-            if not factor.characters: continue
-
-            factors[f].charseq_ids = np.zeros([batch_size, max_sentence_len], np.int32)
-            charseqs_map = {}
-            charseqs = []
-            charseq_lens = []
-            for i in range(batch_size):
-                for j, charseq_id in enumerate(factor.charseq_ids[batch_perm[i]]):
-                    if charseq_id not in charseqs_map:
-                        charseqs_map[charseq_id] = len(charseqs)
-                        charseqs.append(factor.charseqs[charseq_id])
-                    factors[f].charseq_ids[i, j] = charseqs_map[charseq_id]
-
-            factors[f].charseq_lens = np.array([len(charseq) for charseq in charseqs], np.int32)
-            factors[f].charseqs = np.zeros([len(charseqs), np.max(factors[f].charseq_lens)], np.int32)
-            for i in range(len(charseqs)):
-                factors[f].charseqs[i, 0:len(charseqs[i])] = charseqs[i]
-
-        # Analyses data
+            if batch_size:
+                factors[-2].word_ids[np.arange(max_subwords)[np.newaxis, :] < subword_lens[:, np.newaxis]] = \
+                    np.concatenate([self.bert_subwords[i] for i in batch_perm])
+                factors[-1].word_ids[np.arange(max_subwords - 1)[np.newaxis, :] < segment_lens[:, np.newaxis]] = \
+                    np.concatenate([self.bert_segments[i] for i in batch_perm])
+
+        # Analyses data, also as [batch_size, max_sentence_len, max_analyses] candidates with a mask
+        _, tokens = self._ragged_indices(self._factors[self.FORMS].word_ids, batch_perm, width=max_sentence_len)
         for f in [self.LEMMAS, self.TAGS]:
-            factors[f].analyses_ids = []
-            for index in batch_perm:
-                factors[f].analyses_ids.append(self._factors[f].analyses_ids[index])
+            analyses = self._factors[f].analyses_ids
+            factors[f].analyses_ids = [analyses[index] for index in batch_perm]
+
+            token_mask, indices = self._ragged_indices(analyses.values, tokens)
+            candidates = np.zeros(token_mask.shape, np.int32)
+            candidates[token_mask] = analyses.values.values[indices]
+            factors[f].analyses_candidates = np.zeros([batch_size, max_sentence_len, token_mask.shape[1]], np.int32)
+            factors[f].analyses_candidates[mask] = candidates
+            factors[f].analyses_mask = np.zeros(factors[f].analyses_candidates.shape, np.bool_)
+            factors[f].analyses_mask[mask] = token_mask
 
         return batch_sentence_lens, factors
 
@@ -392,11 +1088,7 @@ class MorphoDataset:
                     else:
                         field = factor.words[overrides[f][i]]
                         if f == self.LEMMAS:
-                            try:
-                                field = self._apply_lemma_rule(fields[self.FORMS], field)
-
-                            except:
-                                field = fields[self.FORMS]
+                            field = self._lemma_rule(overrides[f][i]).apply(fields[self.FORMS])
                 fields.append(field)
                 
 
@@ -413,20 +1105,20 @@ class MorphoDataset:
 
     @staticmethod
     def _min_edit_script(source, target):
-        a = [[(len(source) + len(target) + 1, None)] * (len(target) + 1) for _ in range(len(source) + 1)]
-        for i in range(0, len(source) + 1):
-            for j in range(0, len(target) + 1):
-                if i == 0 and j == 0:
-                    a[i][j] = (0, "")
-                else:
-                    if i and a[i - 1][j][0] < a[i][j][0]:
-                        a[i][j] = (a[i - 1][j][0] + 1, a[i - 1][j][1] + "-")
-                    if j and a[i][j - 1][0] < a[i][j][0]:
-                        a[i][j] = (a[i][j - 1][0] + 1, a[i][j - 1][1] + "+" + target[j - 1])
-        return a[-1][-1][1]
+        # The edit script has only deletions and insertions, each of cost one, so every
+        # script costs len(source) + len(target). The DP used to prefer insertions on
+        # ties, which always yields all the deletions followed by all the insertions.
+        return "-" * len(source) + "".join("+" + c for c in target)
+
+    @staticmethod
+    def lemma_rule_cache_info():
+        info = MorphoDataset._gen_lemma_rule.cache_info()
+        return "Lemma rule cache: {} hits, {} misses, {:.2f}% hit rate, {} entries".format(
+            info.hits, info.misses, 100 * info.hits / max(1, info.hits + info.misses), info.currsize)
 
     # ASK co to dělá?
     @staticmethod
+    @functools.lru_cache(maxsize=LEMMA_RULE_CACHE)
     def _gen_lemma_rule(form, lemma):
         form = form.lower()
 
@@ -440,15 +1132,18 @@ class MorphoDataset:
             previous_case = case
         lemma = lemma.lower()
 
+        # Longest common substring, using rows of common prefix lengths of lemma[l:] and form[f:].
+        # On ties, the smallest lemma offset and then the smallest form offset wins.
         best, best_form, best_lemma = 0, 0, 0
-        for l in range(len(lemma)):
-            for f in range(len(form)):
-                cpl = 0
-                while f + cpl < len(form) and l + cpl < len(lemma) and form[f + cpl] == lemma[l + cpl]: cpl += 1
-                if cpl > best:
-                    best = cpl
-                    best_form = f
-                    best_lemma = l
+        previous = [0] * (len(form) + 1)
+        for l in range(len(lemma) - 1, -1, -1):
+            current = [0] * (len(form) + 1)
+            for f in range(len(form) - 1, -1, -1):
+                if form[f] == lemma[l]:
+                    cpl = current[f] = previous[f + 1] + 1
+                    if cpl >= best:
+                        best, best_form, best_lemma = cpl, f, l
+            previous = current
 
         rule = lemma_casing + ";"
         if not best:
@@ -460,49 +1155,20 @@ class MorphoDataset:
             )
         return rule
 
+    def _lemma_rule(self, rule_id):
+        # Lemma rules are compiled lazily, as the lemma vocabulary grows while loading the train data,
+        # and only once for all the datasets sharing the train mappings
+        lemmas = self._factors[self.LEMMAS]
+        if getattr(lemmas, "lemma_rules", None) is None:
+            lemmas.lemma_rules = []
+        if rule_id >= len(lemmas.lemma_rules):
+            lemmas.lemma_rules.extend(self._LemmaRule(word) for word in lemmas.words[len(lemmas.lemma_rules):])
+        return lemmas.lemma_rules[rule_id]
+
+    def apply_lemma_rules(self, forms, rule_ids):
+        # Lemmatize the given forms using the given ids of lemma rules
+        return [self._lemma_rule(rule_id).apply(form) for form, rule_id in zip(forms, rule_ids)]
+
     @staticmethod
     def _apply_lemma_rule(form, lemma_rule):
-        casing, rule = lemma_rule.split(";", 1)
-        if rule.startswith("a"):
-            lemma = rule[1:]
-        else:
-            form = form.lower()
-            rules, rule_sources = rule[1:].split("¦"), []
-            assert len(rules) == 2
-            for rule in rules:
-                source, i = 0, 0
-                while i < len(rule):
-                    if rule[i] == "→" or rule[i] == "-":
-                        source += 1
-                    else:
-                        assert rule[i] == "+"
-                        i += 1
-                    i += 1
-                rule_sources.append(source)
-
-            try:
-                lemma, form_offset = "", 0
-                for i in range(2):
-                    j, offset = 0, (0 if i == 0 else len(form) - rule_sources[1])
-                    while j < len(rules[i]):
-                        if rules[i][j] == "→":
-                            lemma += form[offset]
-                            offset += 1
-                        elif rules[i][j] == "-":
-                            offset += 1
-                        else:
-                            assert (rules[i][j] == "+")
-                            lemma += rules[i][j + 1]
-                            j += 1
-                        j += 1
-                    if i == 0:
-                        lemma += form[rule_sources[0]: len(form) - rule_sources[1]]
-            except:
-                lemma = form
-
-        for rule in casing.split("¦"):
-            if rule == "↓0": continue  # The lemma is lowercased initially
-            case, offset = rule[0], int(rule[1:])
-            lemma = lemma[:offset] + (lemma[offset:].upper() if case == "↑" else lemma[offset:].lower())
-
-        return lemma
+        return MorphoDataset._LemmaRule(lemma_rule).apply(form)
@@ -11,7 +11,12 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_addons as tfa
 import morpho_dataset
+import embeddings_index
+import os
 import pickle
+import tempfile
+from gradient_accumulator import GradientAccumulator
+import tf_compat
 import warnings
 
 
@@ -40,6 +45,8 @@ class BertModel:
             self.model = transformers.TFAutoModel.from_pretrained(self.path, config=self.config)
 
         self.embeddings_only = True if (args.bert and not args.predict) else False
+        self.window = args.bert_window
+        self.window_overlap = args.bert_window_overlap
 
     # @property
     # def model(self):
@@ -57,6 +64,10 @@ class Network:
 
         self.factors = args.factors
         self.factor_words = factor_words
+        # The model and the optimizers are created in the scope of this strategy,
+        # which is the default one (without any replicas) unless --distribute is given
+        self._strategy = tf.distribute.get_strategy()
+        self._distributed = tf.distribute.has_strategy()
         self._optimizer = tfa.optimizers.LazyAdam(beta_2=args.beta_2)
         # predpokladam ze bude jen jeden typ lr a celkovy pocet kroku je tedy takto
         if args.decay_type is not None:
@@ -87,6 +98,16 @@ class Network:
                                                    decay_schedule_fn=learning_rate_fn)
         if args.fine_lr > 0:
             self._fine_optimizer = tfa.optimizers.LazyAdam(beta_2=args.beta_2)
+        # The float16 mixed precision needs loss scaling, bfloat16 has the range of float32
+        self._loss_scaling = bool(args.mixed_precision) and tf_compat.mixed_precision_policy() == "mixed_float16"
+        if self._loss_scaling:
+            self._optimizer = tf_compat.loss_scale_optimizer(self._optimizer)
+        self._accumulator = GradientAccumulator()
+        self._accumulate = args.accu > 1
+        # The finished epochs and the steps of the current one, saved in the checkpoints
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self._checkpoints = None
 
         word_ids = tf.keras.layers.Input(shape=[None], dtype=tf.int32)
         charseq_ids = tf.keras.layers.Input(shape=[None], dtype=tf.int32)
@@ -148,7 +169,9 @@ class Network:
                     tf.keras.layers.Dense(args.rnn_cell_dim, activation=tf.nn.tanh)(factor_layer))])
             if factor == "Lemmas":
                 factor_layer = tf.keras.layers.Concatenate()([factor_layer, cle])
-            outputs.append(tf.keras.layers.Dense(factor_words[factor], activation=tf.nn.softmax)(factor_layer))
+            # The softmax (and therefore the loss) is always computed in float32
+            outputs.append(tf.keras.layers.Dense(factor_words[factor], activation=tf.nn.softmax,
+                                                 dtype=tf.float32)(factor_layer))
 
         inp = [word_ids, charseq_ids, charseqs]
         if (args.embeddings):
@@ -182,9 +205,10 @@ class Network:
             inp2.append(subwords)
 
             self.bert = model.model
-            mask = tf.pad(subwords[:, 1:] != 0, [[0, 0], [1, 0]], constant_values=True)
+            windows, mask = tf.keras.layers.Lambda(
+                lambda subwords: self._bert_windows(subwords, args.bert_window, args.bert_window_overlap))(subwords)
             if args.layers == "att":
-                bert_output = self.bert(subwords, attention_mask=tf.cast(mask, tf.float32))[2]
+                bert_output = self.bert(windows, attention_mask=mask)[2]
                 weights = tf.Variable(tf.zeros([12]), trainable=True)
                 output = 0
                 softmax_weights = tf.nn.softmax(weights)
@@ -193,10 +217,12 @@ class Network:
                     output += result
                 model_output = output
             else:
-                model_output = self.bert(subwords, attention_mask=tf.cast(mask, tf.float32))[2][-4:]
+                model_output = self.bert(windows, attention_mask=mask)[2][-4:]
                 model_output = tf.math.reduce_mean(model_output, axis=0)  # prumerovani vrstev
 
-            bert_output = tf.slice(model_output, [0, 1, 0], [-1, -1, -1])  # odeberu prvni sloupec
+            # odeberu prvni sloupec, z oken se slozi zpet cele vety
+            bert_output = tf.keras.layers.Lambda(lambda inputs: self._bert_stitch(
+                inputs[0], inputs[1], args.bert_window, args.bert_window_overlap))([model_output, subwords])
             bert_output = tf.keras.layers.Lambda(
                 lambda subseq:
                 tf.map_fn(lambda subseq:
@@ -210,52 +236,199 @@ class Network:
         else:
             self.outer_model = self.model
 
-        if args.label_smoothing:
-            self._loss = tf.losses.CategoricalCrossentropy()
-        else:
-            self._loss = tf.losses.SparseCategoricalCrossentropy()
+        if args.predict is None:
+            # Only the chief writes the summaries and the checkpoints, the other workers of
+            # a multi-worker training write theirs into a temporary directory
+            self.logdir = args.logdir if args.chief else tempfile.mkdtemp()
+            self._writer = tf.summary.create_file_writer(self.logdir, flush_millis=10 * 1000)
+
+        # The batches have a fixed signature (and bucketed shapes, see _pipeline), so that the
+        # steps are traced just once; every tracing is counted in self.traces. The signature
+        # of train_batch is the one of the (possibly distributed) training batches, so it is
+        # set in _pipeline.
+        self.traces = collections.Counter()
+        self._train_signature = None
+        signature = [[tf.TensorSpec(tensor.shape, tensor.dtype) for tensor in self.outer_model.inputs],
+                     [tf.TensorSpec([None, None], tf.int32)] * len(self.factors)]
+        self.evaluate_batch = tf.function(self.evaluate_batch, input_signature=signature)
+        # With --jit_compile, the model computations (but not the summaries) are compiled by XLA
+        self._train_step = tf_compat.function(self._train_step, jit_compile=args.jit_compile)
+        self._evaluate_step = tf_compat.function(self._evaluate_step, jit_compile=args.jit_compile)
+        self._apply_accumulated = tf.function(self._apply_accumulated, experimental_relax_shapes=True)
+
+    def create_metrics(self):
+        # The metrics are updated outside of the replicas (by the values reduced over all
+        # the replicas of all the workers), so they are created outside of the strategy scope
         self._metrics = {"loss": tf.metrics.Mean()}
         for f in self.factors:
-            self._metrics[f + "Raw"] = tf.metrics.SparseCategoricalAccuracy()
+            self._metrics[f + "Raw"] = tf.metrics.Mean()
             self._metrics[f + "Dict"] = tf.metrics.Mean()
         if len(self.factors) == 2:
             self._metrics["LemmasTagsRaw"] = tf.metrics.Mean()
             self._metrics["LemmasTagsDict"] = tf.metrics.Mean()
 
-        if args.predict is None:
-            self._writer = tf.summary.create_file_writer(args.logdir, flush_millis=10 * 1000)
-
-    @tf.function(experimental_relax_shapes=True)
-    def train_batch(self, inputs, factors):
+    def create_checkpoints(self, dataset, args):
+        # Keeps the last args.checkpoints checkpoints of the model, the optimizers, the position
+        # in the training and the state of the training dataset, written asynchronously if supported.
+        # Returns whether the training was resumed from an existing checkpoint (all the workers
+        # restore those of the chief).
+        # The dataset state (see MorphoDataset.get_state) is stored pickled in a string variable.
+        self._data_state = tf.Variable(pickle.dumps(dataset.get_state()), dtype=tf.string, trainable=False)
+        objects = dict(model=self.outer_model, optimizer=self._optimizer, epoch=self.epoch, step=self.step,
+                       data=self._data_state)
+        if args.fine_lr > 0:
+            objects["fine_optimizer"] = self._fine_optimizer
+        self._checkpoints = tf.train.CheckpointManager(
+            tf.train.Checkpoint(**objects), "{}/checkpoints".format(self.logdir), max_to_keep=args.checkpoints)
+        self._checkpoint_options = tf_compat.checkpoint_save_options()
+        latest_checkpoint = tf.train.latest_checkpoint("{}/checkpoints".format(args.logdir))
+        if latest_checkpoint is None:
+            return False
+        self._checkpoints.checkpoint.restore(latest_checkpoint)
+        dataset.set_state(pickle.loads(self._data_state.numpy()))
+        return True
+
+    def save_checkpoint(self):
+        if self._checkpoints is not None:
+            self._checkpoints.save(**self._checkpoint_options)
+
+    @staticmethod
+    def _bert_window_frames(length, window, overlap):
+        frame_len, step = window - 2, window - 2 - overlap
+        assert step > 0, "The bert window overlap must be smaller than the window"
+        return 1 + tf.maximum(length - frame_len + step - 1, 0) // step, tf.minimum(length, frame_len), step
+
+    @staticmethod
+    def _bert_windows(subwords, window, overlap):
+        # Split the subwords after the leading special token into windows of at most window - 2
+        # subwords, consecutive ones overlapping by `overlap`, each wrapped in the leading and the
+        # closing special token of its sentence. The frames are computed without the closing token,
+        # so a sentence of at most `window` subwords is unchanged, only its closing token may be moved
+        # after the frame. Returns the windows and their attention mask.
+        inner = subwords[:, 1:]
+        batch, length = tf.shape(inner)[0], tf.shape(inner)[1]
+        frames, frame, step = Network._bert_window_frames(length - 1, window, overlap)
+        inner_lens = tf.reduce_sum(tf.cast(inner != 0, tf.int32), axis=1)
+        closing = tf.gather(inner, tf.maximum(inner_lens - 1, 0), batch_dims=1)
+
+        framed_length = (frames - 1) * step + frame
+        framed = tf.signal.frame(tf.pad(inner, [[0, 0], [0, tf.maximum(framed_length - length, 0)]])[:, :framed_length],
+                                 frame, step)
+        starts = tf.range(frames) * step
+        windows = tf.concat([
+            tf.tile(subwords[:, tf.newaxis, :1], [1, frames, 1]),
+            framed,
+            tf.tile(closing[:, tf.newaxis, tf.newaxis], [1, frames, 1])], axis=2)
+        # The closing token is attended in every window not containing the one of the sentence
+        mask = tf.concat([
+            tf.ones([batch, frames, 1], tf.bool),
+            framed != 0,
+            (starts[tf.newaxis, :] + frame < inner_lens[:, tf.newaxis])[:, :, tf.newaxis]], axis=2)
+        return tf.reshape(windows, [-1, frame + 2]), tf.cast(tf.reshape(mask, [-1, frame + 2]), tf.float32)
+
+    @staticmethod
+    def _bert_stitch(model_output, subwords, window, overlap):
+        # Inverse of _bert_windows, returning the outputs of subwords[:, 1:], each subword
+        # taken from the window where it is farther from the window boundary; the closing token
+        # of the longest sentences may be only after the last frame, so its output is appended
+        batch, length = tf.shape(subwords)[0], tf.shape(subwords)[1] - 1
+        frames, frame, step = Network._bert_window_frames(length - 1, window, overlap)
+        outputs = tf.reshape(model_output, [batch, frames, frame + 2, model_output.shape[-1]])
+        half = overlap // 2
+        return tf.concat([
+            outputs[:, 0, 1:1 + half],
+            tf.reshape(outputs[:, :-1, 1 + half:1 + half + step], [batch, (frames - 1) * step, model_output.shape[-1]]),
+            outputs[:, -1, 1 + half:]], axis=1)[:, :length]
+
+    def _losses(self, factors, probabilities, label_smoothing):
+        # The losses of all factors summed over the tokens, the number of the tokens, and the numbers
+        # of correctly predicted tokens of every factor (followed by those with both factors correct),
+        # so that the means depend neither on the padding nor on the division among the replicas.
+        # The label smoothed cross-entropy is computed from the gold indices without one-hot labels,
+        # as the mean log probability over the vocabulary is the smoothed part of the target.
+        loss, correct, joint = 0.0, [], 1.0
+        for i in range(len(self.factors)):
+            mask = tf.cast(probabilities[i]._keras_mask, tf.float32)
+            log_probabilities = tf.math.log(tf.clip_by_value(probabilities[i], 1e-7, 1 - 1e-7))
+            gold = tf.gather(log_probabilities, factors[i], batch_dims=2)
+            if label_smoothing:
+                gold = (1 - label_smoothing) * gold + label_smoothing * tf.reduce_mean(log_probabilities, axis=2)
+            loss -= tf.reduce_sum(gold * mask)
+
+            matches = tf.cast(tf.argmax(probabilities[i], axis=2, output_type=tf.int32) == factors[i], tf.float32)
+            correct.append(tf.reduce_sum(matches * mask))
+            joint *= matches
+        if len(self.factors) == 2:
+            correct.append(tf.reduce_sum(joint * mask))
+        return loss, tf.reduce_sum(tf.cast(probabilities[0]._keras_mask, tf.float32)), correct
+
+    def _update_metrics(self, loss, tokens, correct):
+        # The loss and the raw accuracies computed by the step, as means over the tokens
+        names = [f + "Raw" for f in self.factors] + ["LemmasTagsRaw"] * (len(self.factors) == 2)
+        self._metrics["loss"](loss / tf.maximum(tokens, 1.), tokens)
+        for name, value in zip(names, correct):
+            self._metrics[name](value / tf.maximum(tokens, 1.), tokens)
+
+    def _train_step(self, inputs, factors):
+        # The computation of train_batch which can be compiled by XLA, including the metrics.
+        # The gradients are those of the loss summed over the tokens, returned together with
+        # the padded size of the batch (the sentences times the longest of them), by which the
+        # mean Keras losses were divided, so that the gradients keep their scale.
         with tf.GradientTape() as tape:
             probabilities = self.outer_model(inputs, training=True)
             tvs = self.outer_model.trainable_variables
 
             if len(self.factors) == 1:
                 probabilities = [probabilities]
-            loss = 0.0
-            for i in range(len(self.factors)):
-                if self.args.label_smoothing:
-                    loss += self._loss(
-                        tf.one_hot(factors[i], self.factor_words[self.factors[i]]) * (1 - self.args.label_smoothing)
-                        + self.args.label_smoothing / self.factor_words[self.factors[i]], probabilities[i],
-                        probabilities[i]._keras_mask)
-                else:
-                    loss += self._loss(tf.convert_to_tensor(factors[i]), probabilities[i], probabilities[i]._keras_mask)
-
-        gradients = tape.gradient(loss, tvs)
-
-        tf.summary.experimental.set_step(self._optimizer.iterations)  # TODO  co to je?
-        with self._writer.as_default():
-            for name, metric in self._metrics.items():
-                metric.reset_states()
-            self._metrics["loss"](loss)
-            for i in range(len(self.factors)):
-                self._metrics[self.factors[i] + "Raw"](factors[i], probabilities[i], probabilities[i]._keras_mask)
+            loss, tokens, correct = self._losses(factors, probabilities, self.args.label_smoothing)
+            scaled_loss = self._optimizer.get_scaled_loss(loss) if self._loss_scaling else loss
+
+        gradients = tape.gradient(scaled_loss, tvs)
+        if self._loss_scaling:
+            gradients = self._optimizer.get_unscaled_gradients(gradients)
+        lengths = tf.reduce_sum(tf.cast(probabilities[0]._keras_mask, tf.int32), axis=1)
+        padded = tf.cast(tf.size(lengths) * tf.reduce_max(lengths), tf.float32)
+        return loss, tokens, padded, correct, gradients
+
+    def _train_replica(self, inputs, factors):
+        loss, tokens, padded, correct, gradients = self._train_step(inputs, factors)
+        metrics = loss, tokens, correct
+
+        # The gradients of the loss summed over the tokens of all replicas, divided by the padded
+        # sizes of all their batches and summed over the replicas. They are applied right away,
+        # unless they are accumulated over several batches.
+        if self._distributed:
+            context = tf.distribute.get_replica_context()
+            padded = context.all_reduce(tf.distribute.ReduceOp.SUM, padded)
+            summed = iter(context.all_reduce(tf.distribute.ReduceOp.SUM, [g for g in gradients if g is not None]))
+            gradients = [None if g is None else next(summed) for g in gradients]
+        padded = tf.maximum(padded, 1.)
+        gradients = [None if g is None else tf.IndexedSlices(g.values / padded, g.indices, g.dense_shape)
+                     if isinstance(g, tf.IndexedSlices) else g / padded for g in gradients]
+        if not self._accumulate:
+            self._apply_replica(gradients)
+            gradients = []
+        return metrics, gradients
 
+    def train_batch(self, inputs, factors):
+        self.traces["train_batch"] += 1
+        if not self._distributed:
+            (loss, tokens, correct), gradients = self._train_replica(inputs, factors)
+        else:
+            (loss, tokens, correct), gradients = self._strategy.run(self._train_replica, args=(inputs, factors))
+            # The metrics are updated by the sums over all the replicas of all the workers
+            loss, tokens, *correct = [self._strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+                                      for value in [loss, tokens] + list(correct)]
+        self._update_metrics(loss, tokens, correct)
+        return gradients
+
+    def _write_train_summaries(self):
+        # The training metrics are running means since the previous summaries, so they are restarted
+        tf.summary.experimental.set_step(self._optimizer.iterations)
+        with self._writer.as_default():
             for name, metric in self._metrics.items():
                 tf.summary.scalar("train/{}".format(name), metric.result())
-        return probabilities, gradients
+                metric.reset_states()
 
     def train_epoch(self, dataset, args, learning_rate):
         if args.decay_type is None:
@@ -265,228 +438,183 @@ class Network:
                 self._optimizer.learning_rate = learning_rate
         if args.fine_lr > 0:
             self._fine_optimizer.learning_rate = args.fine_lr
-        num_gradients = 0
-
-        while not args.train.epoch_finished():
-            sentence_lens, batch = dataset.next_batch(args.batch_size)
-            factors = []
-            for f in self.factors:
-                words = batch[dataset.FACTORS_MAP[f]].word_ids
-                factors.append(words)
+
+        # The checkpoints store the dataset state from the start of the epoch together with the
+        # number of its finished steps, which are skipped when resuming
+        if self._checkpoints is not None:
+            self._data_state.assign(pickle.dumps(dataset.get_state()))
+        skip = int(self.step.numpy())
+        for metric in self._metrics.values():
+            metric.reset_states()
+        summary_steps = 0
+        for _, inp, factors, _ in self._pipeline(dataset, args, train=True, skip=skip):
+            tg = self.train_batch(inp, factors)
+            summary_steps += 1
+            if summary_steps == args.summary_steps:
+                self._write_train_summaries()
+                summary_steps = 0
+
+            if self._accumulate:
+                # The summed gradients are the same on all replicas, those of the first one are accumulated
+                self._accumulator.accumulate([None if g is None else self._strategy.experimental_local_results(g)[0]
+                                              for g in tg])
+                if self._accumulator.steps == args.accu:
+                    self._apply_accumulated(self._accumulator.gradients())
+                    self._accumulator.reset()
+            self.step.assign_add(1)
+            if args.checkpoint_steps and not self._accumulator.steps and self.step.numpy() % args.checkpoint_steps == 0:
+                self.save_checkpoint()
+        if self._accumulator.steps:
+            self._apply_accumulated(self._accumulator.gradients())
+            self._accumulator.reset()
+        if summary_steps:
+            self._write_train_summaries()
+
+        self.epoch.assign_add(1)
+        self.step.assign(0)
+        if self._checkpoints is not None:
+            self._data_state.assign(pickle.dumps(dataset.get_state()))
+            self.save_checkpoint()
+
+    def _apply_accumulated(self, gradients):
+        # The accumulated gradients are already summed over the replicas, every replica applies them as they are
+        if self._distributed:
+            self._strategy.run(self._apply_replica, args=(gradients,))
+        else:
+            self._apply_replica(gradients)
+
+    def _apply_replica(self, gradients):
+        # With --distribute, the optimizers must not aggregate the gradients again
+        # (the default strategy does not accept the option before TF 2.2)
+        aggregate = dict(experimental_aggregate_gradients=False) if self._distributed else {}
+        if self.args.fine_lr > 0:
+            variables = self.outer_model.trainable_variables
+            var1 = variables[0: self.args.lr_split]
+            var2 = variables[self.args.lr_split:]
+            tg1 = gradients[0: self.args.lr_split]
+            tg2 = gradients[self.args.lr_split:]
+
+            self._optimizer.apply_gradients(zip(tg2, var2), **aggregate)
+            self._fine_optimizer.apply_gradients(zip(tg1, var1), **aggregate)
+        else:
+            self._optimizer.apply_gradients(zip(gradients, self.outer_model.trainable_variables), **aggregate)
+
+    def _pipeline(self, dataset, args, analyses=False, train=False, skip=0):
+        # Batches of the dataset created by a tf.data pipeline, overlapping with the computation,
+        # with bucketed lengths so that XLA and the cuDNN kernels see a bounded set of shapes.
+        # Yields sentence lengths, network inputs, gold factors and if `analyses`,
+        # the analyses candidates of the factors followed by the analyses mask.
+        # The `train` batches are those of train_batch, whose signature is set by the first of them;
+        # with --distribute, every replica gets its own batch, the batches being divided among
+        # the workers, and the yielded values are distributed ones. The first `skip` steps are left out.
+        def inputs(sentence_lens, batch):
             inp = [batch[dataset.FORMS].word_ids, batch[dataset.FORMS].charseq_ids, batch[dataset.FORMS].charseqs]
-            print('train epoch')
             if args.embeddings:
-                embeddings = self._compute_embeddings(batch, dataset, args)
-                inp.append(embeddings)
-
+                inp.append(self._compute_embeddings(batch, dataset, args))
             if args.bert:
-                bert_embeddings = self._compute_bert(batch, dataset, sentence_lens)
-                inp.append(bert_embeddings)
-
+                inp.append(self._compute_bert(batch, dataset, sentence_lens))
             if args.bert_model:
                 inp.append(batch[dataset.SEGMENTS].word_ids)
                 inp.append(batch[dataset.SUBWORDS].word_ids)
+            factors = [batch[dataset.FACTORS_MAP[f]].word_ids for f in self.factors]
+            rest = []
+            if analyses:
+                rest = [batch[dataset.FACTORS_MAP[f]].analyses_candidates for f in self.factors]
+                rest.append(batch[dataset.FACTORS_MAP[self.factors[0]]].analyses_mask)
+            return [sentence_lens] + inp + factors + rest
+
+        inputs_count = 3 + bool(args.embeddings) + bool(args.bert) + 2 * bool(args.bert_model)
+        if train and self._distributed:
+            batches = self._strategy.distribute_datasets_from_function(lambda context: dataset.tf_dataset(
+                args.batch_size, inputs, buckets=True, shards=context.num_input_pipelines,
+                shard=context.input_pipeline_id, replicas=context.num_replicas_in_sync // context.num_input_pipelines,
+                skip=skip * (context.num_replicas_in_sync // context.num_input_pipelines)))
+        else:
+            batches = dataset.tf_dataset(args.batch_size, inputs, buckets=True, skip=skip)
+        for element in batches:
+            if train and self._train_signature is None:
+                spec = batches.element_spec[1:]
+                self._train_signature = [list(spec[:inputs_count]), list(spec[inputs_count:inputs_count + len(self.factors)])]
+                self.train_batch = tf.function(self.train_batch, input_signature=self._train_signature)
+            sentence_lens, element = element[0], element[1:]
+            inp, element = list(element[:inputs_count]), element[inputs_count:]
+            factors, rest = list(element[:len(self.factors)]), list(element[len(self.factors):])
+            if not train:
+                sentence_lens, rest = sentence_lens.numpy(), [array.numpy() for array in rest]
+            yield sentence_lens, inp, factors, rest
 
-            p, tg = self.train_batch(inp, factors)
-
-            if args.accu < 2:
-
-                if args.fine_lr > 0:
-                    variables = self.outer_model.trainable_variables
-                    var1 = variables[0: args.lr_split]
-                    var2 = variables[args.lr_split:]
-                    tg1 = tg[0: args.lr_split]
-                    tg2 = tg[args.lr_split:]
-
-                    self._optimizer.apply_gradients(zip(tg2, var2))
-                    self._fine_optimizer.apply_gradients(zip(tg1, var1))
-                else:
-                    self._optimizer.apply_gradients(zip(tg, self.outer_model.trainable_variables))
-            else:
-                if num_gradients == 0:
-                    gradients = []
-                    for index, g in enumerate(tg):
-                        if g == None:
-                            gradients.append(None)
-                        elif not isinstance(g, tf.IndexedSlices):
-                            gradients.append(g.numpy())
-                        else:
-                            gradients.append([(g.values.numpy(), g.indices.numpy())])
-
-                    # gradients = [
-                    #   g.numpy() if not isinstance(g, tf.IndexedSlices) else [(g.values.numpy(), g.indices.numpy())] for g
-                    #   in tg]
-                else:
-
-                    for g, ng in zip(gradients, tg):
-                        if ng != None:
-                            if isinstance(g, list):
-                                g.append((ng.values.numpy(), ng.indices.numpy()))
-                            else:
-                                g += ng.numpy()
-                num_gradients += 1
-                if num_gradients == args.accu or len(args.train._permutation) == 0:
-                    gradients = gradients
-                    gradients = [tf.IndexedSlices(*map(np.concatenate, zip(*g))) if isinstance(g, list) else g for g in
-                                 gradients]
-                    if args.fine_lr > 0:
-                        variables = self.outer_model.trainable_variables
-                        var1 = variables[0: args.lr_split]
-                        var2 = variables[args.lr_split:]
-                        tg1 = gradients[0: args.lr_split]
-                        tg2 = gradients[args.lr_split:]
-
-                        self._optimizer.apply_gradients(zip(tg2, var2))
-                        self._fine_optimizer.apply_gradients(zip(tg1, var1))
-                    else:
-                        self._optimizer.apply_gradients(zip(gradients, self.outer_model.trainable_variables))
-                    num_gradients = 0
-
-    # TODO create inputs jako jednu metodu pro train i evaluate!
     # TODO vytvareni modelu jako jedna metoda pro outer i inner model
     def _compute_bert(self, batch, dataset, lenghts):
-
-        # max_len = np.max([len(batch[dataset.BERT].word_ids[i]) for i in range(len(batch[dataset.BERT].word_ids))])
-        # FIXME DATASET.BERT
-        max_len = batch[dataset.EMBEDDINGS].word_ids.shape[1]
-        result = np.zeros((len(batch[dataset.BERT].word_ids), max_len, len(batch[dataset.BERT].word_ids[0][0])))
-        for sentence in range(len(batch[dataset.BERT].word_ids)):
-            result[sentence][0:len(batch[dataset.BERT].word_ids[sentence])] = batch[dataset.BERT].word_ids[sentence]
-
-        return result
+        # The batch already contains the padded float32 BERT embeddings
+        return batch[dataset.BERT].word_ids
 
     def _compute_embeddings(self, batch, dataset,args):
-        embeddings = np.zeros([batch[dataset.EMBEDDINGS].word_ids.shape[0],
-                               batch[dataset.EMBEDDINGS].word_ids.shape[1],
-                               args.embeddings_size])
-        for i in range(embeddings.shape[0]):
-            for j in range(embeddings.shape[1]):
-                if batch[dataset.EMBEDDINGS].word_ids[i, j]:
-                    embeddings[i, j] = args.embeddings_data[batch[dataset.EMBEDDINGS].word_ids[i, j] - 1]
-        return embeddings
-
-    # TODO predelat, kdyz uz to vraci rovnou embeddings
-    def _compute_bert_embeddings(self, batch, dataset,args):
-        bert_embeddings = np.zeros([batch[dataset.BERT].word_ids.shape[0],
-                                    batch[dataset.BERT].word_ids.shape[1],
-                                    args.bert_size])
-        for i in range(bert_embeddings.shape[0]):
-            for j in range(bert_embeddings.shape[1]):
-                if batch[dataset.BERT].word_ids[i, j]:
-                    bert_embeddings[i, j] = dataset.bert_embeddings[batch[dataset.BERT].word_ids[i, j] - 1]
-
-        return bert_embeddings
-
-    @tf.function(experimental_relax_shapes=True)
-    def evaluate_batch(self, inputs, factors):
+        # The embeddings matrix starts with a zero row for the padding id 0
+        return args.embeddings_data[batch[dataset.EMBEDDINGS].word_ids]
+
+    def _evaluate_step(self, inputs, factors):
         probabilities = self.outer_model(inputs, training=False)
         if len(self.factors) == 1:
             probabilities = [probabilities]
-        loss = 0
-        for i in range(len(self.factors)):
-            if self.args.label_smoothing:
-                loss += self._loss(tf.one_hot(factors[i], self.factor_words[self.factors[i]]), probabilities[i],
-                                   probabilities[i]._keras_mask)
-            else:
-                loss += self._loss(tf.convert_to_tensor(factors[i]), probabilities[i], probabilities[i]._keras_mask)
+        loss, tokens, correct = self._losses(factors, probabilities, 0.)
+        return probabilities, [p._keras_mask for p in probabilities], loss, tokens, correct
 
-        self._metrics["loss"](loss)
-        for i in range(len(self.factors)):
-            self._metrics[self.factors[i] + "Raw"](factors[i], probabilities[i], probabilities[i]._keras_mask)
-
-        return probabilities, [probabilities[f]._keras_mask for f in range(len(self.factors))]
+    def evaluate_batch(self, inputs, factors):
+        # Every worker evaluates all the batches by itself, without the replicas
+        self.traces["evaluate_batch"] += 1
+        probabilities, masks, loss, tokens, correct = self._evaluate_step(inputs, factors)
+        self._update_metrics(loss, tokens, correct)
+        return probabilities, masks
+
+    def _dictionary_predictions(self, dataset, analyses, probabilities):
+        # Predictions constrained by the morphological analyses, decided for the whole batch at once.
+        # For tokens with at least one known analysis, unknown analyses get the minimum probability
+        # of a known analysis - 1e-3, and the analysis with the largest sum of probabilities wins.
+        # The `analyses` are the candidates of the factors followed by the analyses mask.
+        predictions = [tf.argmax(p, axis=2, output_type=tf.int32).numpy() for p in probabilities]
+        candidates, mask = analyses[:-1], analyses[-1]
+        if not mask.shape[2]:
+            return predictions
+
+        known, scores = mask, 0
+        for f in range(len(self.factors)):
+            known = np.logical_and(known, candidates[f] != dataset.UNK)
+            analysis_probs = tf.gather(probabilities[f], candidates[f], batch_dims=2).numpy()
+            min_probability = np.min(np.where(mask & (candidates[f] != dataset.UNK), analysis_probs, np.inf),
+                                     axis=2, keepdims=True) - 1e-3
+            scores += np.where((candidates[f] == dataset.UNK) | (candidates[f] == dataset.PAD),
+                               min_probability, analysis_probs)
+        best_index = np.argmax(np.where(mask, scores, -np.inf), axis=2)[:, :, np.newaxis]
+
+        known_analysis = np.any(known, axis=2)
+        for f in range(len(self.factors)):
+            predictions[f] = np.where(known_analysis, np.take_along_axis(candidates[f], best_index, axis=2)[:, :, 0],
+                                      predictions[f])
+        return predictions
 
     def evaluate(self, dataset, dataset_name, args, predict=None):
         for metric in self._metrics.values():
             metric.reset_states()
         if predict is not None:
             sentences = 0
-        while not dataset.epoch_finished():
-            sentence_lens, batch = dataset.next_batch(args.batch_size)
-            print(batch)
-
-            factors = []
-            for f in self.factors:
-                factors.append(batch[dataset.FACTORS_MAP[f]].word_ids)
-            any_analyses = any(batch[args.train.FACTORS_MAP[factor]].analyses_ids for factor in self.factors)
-            inp = [batch[dataset.FORMS].word_ids, batch[dataset.FORMS].charseq_ids, batch[dataset.FORMS].charseqs]
-            if args.embeddings:
-                embeddings = self._compute_embeddings(batch, dataset,args)
-                inp.append(embeddings)
-
-            if args.bert:
-                bert_embeddings = self._compute_bert(batch, dataset, sentence_lens)
-                inp.append(bert_embeddings)
-
-            if args.bert_model:
-                inp.append(batch[dataset.SEGMENTS].word_ids)
-                inp.append(batch[dataset.SUBWORDS].word_ids)
-
+        for sentence_lens, inp, factors, analyses in self._pipeline(dataset, args, analyses=True):
             probabilities, mask = self.evaluate_batch(inp, factors)
+            factors = [factor.numpy() for factor in factors]
 
-            if any_analyses:
-                predictions = [np.argmax(p, axis=2) for p in probabilities]
-
-                for i in range(len(sentence_lens)):
-                    for j in range(sentence_lens[i]):
-
-                        analysis_ids = [batch[dataset.FACTORS_MAP[factor]].analyses_ids[i][j] for factor in
-                                        self.factors]
-                        if not analysis_ids or len(analysis_ids[0]) == 0:
-                            continue
-
-                        known_analysis = any(all(analysis_ids[f][a] != dataset.UNK for f in range(len(self.factors)))
-                                             for a in range(len(analysis_ids[0])))
-                        if not known_analysis:
-                            continue
-
-                        # Compute probabilities of unknown analyses as minimum probability
-                        # of a known analysis - 1e-3.
-
-                        analysis_probs = [probabilities[factor][i, j].numpy() for factor in range(len(self.factors))]
-
-                        for f in range(len(args.factors)):
-                            min_probability = None
-                            for analysis in analysis_ids[f]:
-
-                                # TODO spatny shape, probabilities f analysis je vektor
-                                if analysis != dataset.UNK and (min_probability is None or analysis_probs[f][
-                                    analysis] - 1e-3 < min_probability):
-                                    min_probability = analysis_probs[f][analysis] - 1e-3
-
-                            analysis_probs[f][dataset.UNK] = min_probability
-                            analysis_probs[f][dataset.PAD] = min_probability
-
-                        best_index, best_prob = None, None
-                        for index in range(len(analysis_ids[0])):
-                            prob = sum(analysis_probs[f][analysis_ids[f][index]] for f in range(len(args.factors)))
-                            if best_index is None or prob > best_prob:
-                                best_index, best_prob = index, prob
-                        for f in range(len(args.factors)):
-                            predictions[f][i, j] = analysis_ids[f][best_index]
+            predictions = self._dictionary_predictions(dataset, analyses, probabilities)
 
             for fc in range(len(self.factors)):
                 self._metrics[self.factors[fc] + "Dict"](factors[fc] == predictions[fc],
                                                          mask[fc])
             if len(self.factors) == 2:
-                predictions_raw = [np.argmax(p, axis=2) for p in probabilities]
                 self._metrics["LemmasTagsDict"](
                     np.logical_and(factors[0] == predictions[0], factors[1] == predictions[1]), mask[0])
-                self._metrics["LemmasTagsRaw"](
-                    np.logical_and(factors[0] == predictions_raw[0], factors[1] == predictions_raw[1]), mask[0])
 
             if predict is not None:
-
-                print("delka vet")
-                print(len(sentence_lens))
                 for i in range(len(sentence_lens)):
                     overrides = [None] * dataset.FACTORS
                     for f,factor in enumerate(args.factors):
                         overrides[dataset.FACTORS_MAP[factor]] = predictions[f][i]
-                        print(overrides)
-                        
-                        print("pred")
-                        print(predictions[f][i])
                     dataset.write_sentence(predict, sentences, overrides)
                     sentences += 1
 
@@ -501,75 +629,15 @@ class Network:
 
     def predict(self, dataset, args, predict, compare=False):
         sentences = 0
-        while not dataset.epoch_finished():
-            sentence_lens, batch = dataset.next_batch(args.batch_size)
-
-            factors = []
-            for f in self.factors:
-                factors.append(batch[dataset.FACTORS_MAP[f]].word_ids)
-            any_analyses = any(batch[args.train.FACTORS_MAP[factor]].analyses_ids for factor in self.factors)
-            inp = [batch[dataset.FORMS].word_ids, batch[dataset.FORMS].charseq_ids, batch[dataset.FORMS].charseqs]
-            if args.embeddings:
-                embeddings = self._compute_embeddings(batch, dataset,args)
-                inp.append(embeddings)
-
-            if args.bert:
-                bert_embeddings = self._compute_bert(batch, dataset, sentence_lens)
-                inp.append(bert_embeddings)
-
-            if args.bert_model:
-                inp.append(batch[dataset.SEGMENTS].word_ids)
-                inp.append(batch[dataset.SUBWORDS].word_ids)
-
+        for sentence_lens, inp, factors, analyses in self._pipeline(dataset, args, analyses=True):
             probabilities, mask = self.evaluate_batch(inp, factors)
+            factors = [factor.numpy() for factor in factors]
 
-            if any_analyses:
-                predictions = [np.argmax(p, axis=2) for p in probabilities]
-
-                for i in range(len(sentence_lens)):
-                    for j in range(sentence_lens[i]):
-
-                        analysis_ids = [batch[dataset.FACTORS_MAP[factor]].analyses_ids[i][j] for factor in
-                                        self.factors]
-                        if not analysis_ids or len(analysis_ids[0]) == 0:
-                            continue
-
-                        known_analysis = any(all(analysis_ids[f][a] != dataset.UNK for f in range(len(self.factors)))
-                                             for a in range(len(analysis_ids[0])))
-                        if not known_analysis:
-                            continue
-
-                        # Compute probabilities of unknown analyses as minimum probability
-                        # of a known analysis - 1e-3.
-
-                        analysis_probs = [probabilities[factor][i, j].numpy() for factor in range(len(self.factors))]
-
-                        for f in range(len(args.factors)):
-                            min_probability = None
-                            for analysis in analysis_ids[f]:
-
-                                # TODO spatny shape, probabilities f analysis je vektor
-                                if analysis != dataset.UNK and (min_probability is None or analysis_probs[f][
-                                    analysis] - 1e-3 < min_probability):
-                                    min_probability = analysis_probs[f][analysis] - 1e-3
-
-                            analysis_probs[f][dataset.UNK] = min_probability
-                            analysis_probs[f][dataset.PAD] = min_probability
-
-                        best_index, best_prob = None, None
-                        for index in range(len(analysis_ids[0])):
-                            prob = sum(analysis_probs[f][analysis_ids[f][index]] for f in range(len(args.factors)))
-                            if best_index is None or prob > best_prob:
-                                best_index, best_prob = index, prob
-                        for f in range(len(args.factors)):
-                            predictions[f][i, j] = analysis_ids[f][best_index]
+            predictions = self._dictionary_predictions(dataset, analyses, probabilities)
 
             for fc in range(len(self.factors)):
                 predpoved = np.array(factors[fc] == predictions[fc])
 
-
-            print("delka vet")
-            print(len(sentence_lens))
             for i in range(len(sentence_lens)):
                 overrides = [None] * dataset.FACTORS
                 results = [None] * dataset.FACTORS
@@ -587,31 +655,44 @@ class Network:
                 dataset.write_sentence(predict, sentences, overrides, results)
                 sentences += 1
 
-def main(args):
-    import argparse
-    import datetime
-    import json
-    import os
-    import re
-
-    np.random.seed(42)
-    tf.random.set_seed(42)
+    def predict_stream(self, input, args, output, bert=None):
+        # Tag the input incrementally in chunks of at most args.stream_buffer sentences,
+        # so that the memory stays bounded and the output of every chunk appears right away
+        for lines in morpho_dataset.MorphoDataset.read_sentences(input, args.stream_buffer):
+            dataset = morpho_dataset.MorphoDataset(lines, train=args.train, shuffle_batches=False, bert=bert,
+                                                   max_tokens=args.max_tokens)
+            self.predict(dataset, args, output)
+            output.flush()
 
-    #command_line = " ".join(sys.argv[1:])
+def parse_args(args):
+    import argparse
 
     # Parse arguments
     parser = argparse.ArgumentParser()
     # parser.add_argument("--threads", default=4, type=int, help="Maximum number of threads to use.")
     parser.add_argument("--accu", default=1, type=int, help="accumulate batch size")
     parser.add_argument("--batch_size", default=64, type=int, help="Batch size.")
+    parser.add_argument("--cache", default=None, type=str, help="Directory for compiled corpora.")
     parser.add_argument("--bert", default=None, type=str, help="Bert model for embeddings")
     parser.add_argument("--bert_model", default=None, type=str, help="Bert model for training")
+    parser.add_argument("--bert_window", default=512, type=int,
+                        help="Maximum subwords encoded by bert at once, longer sentences are split into windows.")
+    parser.add_argument("--bert_window_overlap", default=128, type=int, help="Subwords shared by consecutive windows.")
     parser.add_argument("--beta_2", default=0.99, type=float, help="Adam beta 2")
     parser.add_argument("--char_dropout", default=0, type=float, help="Character dropout")
     parser.add_argument("--checkp", default=None, type=str, help="Checkpoint name")
+    parser.add_argument("--checkpoint_steps", default=0, type=int,
+                        help="Save a training checkpoint also every this many steps.")
+    parser.add_argument("--checkpoints", default=0, type=int,
+                        help="Keep this many training checkpoints saved after every epoch and resume from the last one.")
     parser.add_argument("--cle_dim", default=256, type=int, help="Character-level embedding dimension.")
     parser.add_argument("--cont", default=0, type=int, help="load finetuned model and continue training?")
+    parser.add_argument("--cpu_replicas", default=0, type=int,
+                        help="Split the CPU into this many devices, i.e., to try --distribute locally.")
     parser.add_argument("--debug", default=0, type=int, help="debug on small dataset")
+    parser.add_argument("--distribute", default=None, type=str,
+                        help="Data-parallel training, either 'mirrored' (all local GPUs, or the CPU devices "
+                             "without them) or 'multi_worker' (several hosts described by TF_CONFIG).")
     parser.add_argument("--dropout", default=0.5, type=float, help="Dropout")
     parser.add_argument("--embeddings", default=None, type=str, help="External embeddings to use.")
     parser.add_argument("--epochs", default="40:1e-3,20:1e-4", type=str, help="Epochs and learning rates.")
@@ -620,15 +701,28 @@ def main(args):
     parser.add_argument("--factors", default="Lemmas,Tags", type=str, help="Factors to predict.")
     parser.add_argument("--fine_lr", default=0, type=float, help="Learning rate for bert layers")
     parser.add_argument("--label_smoothing", default=0.00, type=float, help="Label smoothing.")
+    parser.add_argument("--jit_compile", default=0, type=int, help="Compile the train and evaluation steps by XLA.")
     parser.add_argument("--layers", default=None, type=str, help="Which layers should be used")
     parser.add_argument("--lemma_re_strip", default=r"(?<=.)(?:`|_|-[^0-9]).*$", type=str,
                         help="RE suffix to strip from lemma.")
     parser.add_argument("--lemma_rule_min", default=2, type=int, help="Minimum occurences to keep a lemma rule.")
+    parser.add_argument("--load_workers", default=1, type=int,
+                        help="Load the data files by this many parallel processes.")
+    parser.add_argument("--max_tokens", default=None, type=int,
+                        help="Maximum padded tokens in a batch, batching sentences of similar length.")
     # parser.add_argument("--min_epoch_batches", default=300, type=int, help="Minimum number of batches per epoch.")
+    parser.add_argument("--mixed_precision", default=0, type=int,
+                        help="Use mixed precision, bfloat16 on CPU and float16 with loss scaling on GPU.")
+    parser.add_argument("--output", default=None, type=str, help="Prediction output, '-' for standard output.")
     parser.add_argument("--predict", default=None, type=str, help="Predict using the passed model.")
+    parser.add_argument("--quiet", default=0, type=int, help="Write the epoch results only to the log file.")
     parser.add_argument("--rnn_cell", default="LSTM", type=str, help="RNN cell type.")
     parser.add_argument("--rnn_cell_dim", default=512, type=int, help="RNN cell dimension.")
     parser.add_argument("--rnn_layers", default=3, type=int, help="RNN layers.")
+    parser.add_argument("--stream_buffer", default=0, type=int,
+                        help="Predict reading at most this many sentences at a time, '-' data for standard input.")
+    parser.add_argument("--summary_steps", default=100, type=int,
+                        help="Write the means of the training metrics every this many steps.")
     parser.add_argument("--test_only", default=None, type=str, help="Only test evaluation")
     parser.add_argument("--warmup_decay", default=None, type=str,
                         help="Type i or c. Number of warmup steps, than will be applied inverse square root decay")
@@ -681,6 +775,92 @@ def main(args):
     if args.predict is not None:
         args.bert_load  = None
 
+    return args, name
+
+
+def load_embeddings(args):
+    if args.embeddings and os.path.isdir(args.embeddings):
+        # The memory-mapped format of embeddings/convert_vec_to_npz.py, looked up by the index
+        # (float16 and int8 rows are converted to float32 only when gathered for a batch)
+        args.embeddings_words = embeddings_index.EmbeddingsIndex(args.embeddings)
+        args.embeddings_size = args.embeddings_words.dimension
+        args.embeddings_data = args.embeddings_words
+    elif args.embeddings:
+        with np.load(args.embeddings, allow_pickle=True) as embeddings_npz:
+            args.embeddings_words = embeddings_npz["words"]
+            args.embeddings_size = embeddings_npz["embeddings"].shape[1]
+            # Row i + 1 is the embedding of words[i], row 0 is zero for the padding
+            args.embeddings_data = np.zeros([len(args.embeddings_words) + 1, args.embeddings_size], np.float32)
+            args.embeddings_data[1:] = embeddings_npz["embeddings"]
+
+
+def create_strategy(args):
+    # The distribution strategy, created before TensorFlow initializes its devices
+    if args.distribute or args.cpu_replicas > 1:
+        tf_compat.check_distribute()
+    if args.cpu_replicas > 1:
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * args.cpu_replicas)
+
+    # The policy must be set before any layer (including the BERT ones) is created
+    if args.mixed_precision:
+        tf_compat.set_mixed_precision_policy(tf_compat.mixed_precision_policy())
+
+    if args.distribute == "mirrored":
+        devices = tf.config.list_logical_devices("GPU") or tf.config.list_logical_devices("CPU")
+        return tf.distribute.MirroredStrategy([device.name for device in devices])
+    if args.distribute == "multi_worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    assert args.distribute is None, "Unknown --distribute {}".format(args.distribute)
+    return tf.distribute.get_strategy()
+
+
+def create_network(args, model_bert):
+    # TODO nacitat velikost
+    args.bert_size = 768
+    if args.decay_type != None:
+        args.steps_in_epoch = math.floor(len(args.train.factors[1].word_strings) / (args.batch_size * args.accu))
+    with args.strategy.scope():
+        network = Network(args=args,
+                          num_words=len(args.train.factors[args.train.FORMS].words),
+                          num_chars=len(args.train.factors[args.train.FORMS].alphabet),
+                          factor_words=dict(
+                              (factor, len(args.train.factors[args.train.FACTORS_MAP[factor]].words)) for factor in args.factors),
+                          model=model_bert)
+    network.create_metrics()
+
+    if args.debug:
+        ...
+        # tf.keras.utils.plot_model(network.outer_model, "my_first_model_with_shape_info.svg", show_shapes=True)
+
+    if args.fine_lr > 0:
+        args.lr_split = len(network.outer_model.trainable_variables) - len(network.model.trainable_variables)
+
+    # print("model variables:")
+    # print(str(network.model.trainable_variables))
+    # print("outer model variables:")
+    # print(str(network.outer_model.trainable_variables))
+    network.args = args
+    return network
+
+
+def main(args):
+    import datetime
+    import json
+    import os
+    import re
+    import time
+
+    np.random.seed(42)
+    tf.random.set_seed(42)
+
+    #command_line = " ".join(sys.argv[1:])
+
+    args, name = parse_args(args)
+    output = None
+    if args.output == "-":
+        # The standard output is reserved for the predictions, everything else goes to stderr
+        output, sys.stdout = sys.stdout, sys.stderr
 
     # TODO vyřešit
     # tf.config.threading.set_inter_op_parallelism_threads(args.threads)
@@ -706,19 +886,19 @@ def main(args):
         with open("{}/options.json".format(args.logdir), mode="w") as options_file:
             json.dump(vars(args), options_file, sort_keys=True)
 
+    args.strategy = create_strategy(args)
+    args.chief = args.distribute != "multi_worker" or tf_compat.is_multi_worker_chief()
+
     # Load embeddings
-    if args.embeddings:
-        with np.load(args.embeddings, allow_pickle=True) as embeddings_npz:
-            args.embeddings_words = embeddings_npz["words"]
-            args.embeddings_data = embeddings_npz["embeddings"]
-            args.embeddings_size = args.embeddings_data.shape[1]
+    load_embeddings(args)
 
         # Nechceme to vsechno dohromady
     if args.bert and args.bert_model:
         warnings.warn("embeddings and whole bert model training are both selected.")
     model_bert = None
     if args.bert or args.bert_model:
-        model_bert = BertModel(name, args)
+        with args.strategy.scope():
+            model_bert = BertModel(name, args)
 
     if args.predict:
         # Load training dataset maps from the checkpoint
@@ -726,8 +906,10 @@ def main(args):
         args.train = morpho_dataset.MorphoDataset.load_mappings("models/{}/mappings.pickle".format(saved))  # To je ulozeno v
         # models/jmeno experimentu a checkpoints, predict bude jmneo modelu, v data bude cele jeno vcetne test.txt
         # Load input data
-        predict = morpho_dataset.MorphoDataset(args.data, train=args.train, shuffle_batches=False,
-                                               bert=model_bert)
+        if not args.stream_buffer:
+            predict = morpho_dataset.MorphoDataset(args.data, train=args.train, shuffle_batches=False,
+                                                   bert=model_bert, cache=args.cache, max_tokens=args.max_tokens,
+                                                   workers=args.load_workers)
     else:
         # Load input data
         data_paths = [None] * 3
@@ -745,96 +927,100 @@ def main(args):
                                              embeddings=args.embeddings_words if args.embeddings else None,
                                              bert=model_bert,
                                              lemma_re_strip=args.lemma_re_strip,
-                                             lemma_rule_min=args.lemma_rule_min)
+                                             lemma_rule_min=args.lemma_rule_min,
+                                             cache=args.cache, max_tokens=args.max_tokens, workers=args.load_workers)
 
         if os.path.exists(data_paths[1]):
             args.dev = morpho_dataset.MorphoDataset(data_paths[1], train=args.train, shuffle_batches=False,
-                                               bert=model_bert
-                                               )
+                                               bert=model_bert, cache=args.cache, max_tokens=args.max_tokens,
+                                               workers=args.load_workers)
         else:
             args.dev = None
 
         if os.path.exists(data_paths[2]):
             args.test = morpho_dataset.MorphoDataset(data_paths[2], train=args.train, shuffle_batches=False,
-                                                bert=model_bert
-                                                )
+                                                bert=model_bert, cache=args.cache, max_tokens=args.max_tokens,
+                                                workers=args.load_workers)
         else:
             args.test = None
 
-    print(args.bert_load)
-    print("again")
-    # TODO nacitat velikost
-    args.bert_size = 768
-    if args.decay_type != None:
-        args.steps_in_epoch = math.floor(len(args.train.factors[1].word_strings) / (args.batch_size * args.accu))
-    network = Network(args=args,
-                      num_words=len(args.train.factors[args.train.FORMS].words),
-                      num_chars=len(args.train.factors[args.train.FORMS].alphabet),
-                      factor_words=dict(
-                          (factor, len(args.train.factors[args.train.FACTORS_MAP[factor]].words)) for factor in args.factors),
-                      model=model_bert)
-
-    if args.debug:
-        ...
-        # tf.keras.utils.plot_model(network.outer_model, "my_first_model_with_shape_info.svg", show_shapes=True)
-
-    if args.fine_lr > 0:
-        args.lr_split = len(network.outer_model.trainable_variables) - len(network.model.trainable_variables)
-
-    # print("model variables:")
-    # print(str(network.model.trainable_variables))
-    # print("outer model variables:")
-    # print(str(network.outer_model.trainable_variables))
-    network.args = args
+    print(morpho_dataset.MorphoDataset.lemma_rule_cache_info(), file=sys.stderr, flush=True)
+    if args.embeddings and not args.predict:
+        for name, dataset in [("Train", args.train), ("Dev", args.dev), ("Test", args.test)]:
+            if dataset is not None:
+                print("{} {}".format(name, dataset.embeddings_info()), file=sys.stderr, flush=True)
+    network = create_network(args, model_bert)
     if args.predict:
         # network.saver_inference.restore(network.session, "{}/checkpoint-inference".format(args.predict))
         network.outer_model.load_weights(args.predict)
-        network.predict(predict, args, open(saved + "_vystup", "w"),compare=False)
+        if output is None:
+            output = open(args.output or saved + "_vystup", "w")
+        if args.stream_buffer:
+            network.predict_stream(sys.stdin if args.data == "-" else open(args.data, "r", encoding="utf-8"), args,
+                                   output, model_bert)
+        else:
+            network.predict(predict, args, output, compare=False)
 
     else:
-        log_file = open("{}/log".format(args.logdir), "w")
+        # An interrupted training with the same experiment name continues from its last checkpoint
+        resumed = args.checkpoints and network.create_checkpoints(args.train, args)
+        finished_epochs = int(network.epoch.numpy())
+        log_file = open("{}/log".format(network.logdir), "a" if resumed else "w")
         for factor in args.factors:
             print("{}: {}".format(factor, len(args.train.factors[args.train.FACTORS_MAP[factor]].words)), file=log_file,
                   flush=True)
-        print("Tagging with args:", "\n".join(("{}: {}".format(key, value) for key, value in sorted(vars(args).items())
-                                               if key not in ["embeddings_data", "embeddings_words","train","test","dev"])), flush=True)
+        if not args.quiet:
+            print("Tagging with args:", "\n".join(("{}: {}".format(key, value) for key, value in sorted(vars(args).items())
+                                                   if key not in ["embeddings_data", "embeddings_words","train","test","dev","strategy"])), flush=True)
+
+        def log(message):
+            # The epoch results go to the log file and unless --quiet also to the standard error
+            for f in [log_file] + [sys.stderr] * (not args.quiet):
+                print(message, file=f, flush=True)
 
         def test_eval(predict=None):
             metrics = network.evaluate(args.test, "test", args, predict)
             metrics_log = ", ".join(("{}: {:.2f}".format(metric, 100 * metrics[metric]) for metric in metrics))
-            for f in [sys.stderr, log_file]:
-                print("Test, epoch {}, lr {}, {}".format(epoch + 1, learning_rate, metrics_log), file=f, flush=True)
+            log("Test, epoch {}, lr {}, {}".format(epoch + 1, learning_rate, metrics_log))
 
         for i, (epochs, learning_rate) in enumerate(args.epochs):
             tf.summary.experimental.set_step(0)
             epoch = 0
             test_eval()
             for epoch in range(epochs):
+                if finished_epochs:
+                    finished_epochs -= 1
+                    continue
+                start = time.time()
                 network.train_epoch(args.train, args, learning_rate)
+                speed = len(args.train.sentence_lens) / (time.time() - start)
+                traces_log = ", ".join("{}: {}".format(name, count) for name, count in sorted(network.traces.items()))
+                log("Speed, epoch {}, {:.1f} sentences/s".format(epoch + 1, speed))
+                log("Traces, epoch {}, {}".format(epoch + 1, traces_log))
 
                 if args.dev:
-                    print("evaluate")
                     metrics = network.evaluate(args.dev, "dev", args)
                     metrics_log = ", ".join(("{}: {:.2f}".format(metric, 100 * metrics[metric]) for metric in metrics))
-                    for f in [sys.stderr, log_file]:
-                        print("Dev, epoch {}, lr {}, {}".format(epoch + 1, learning_rate, metrics_log), file=f,
-                              flush=True)
+                    log("Dev, epoch {}, lr {}, {}".format(epoch + 1, learning_rate, metrics_log))
 
                 if args.cont and test:
                     test_eval()
 
-            args.train.save_mappings("{}/mappings.pickle".format(args.logdir))
+            if args.chief:
+                args.train.save_mappings("{}/mappings.pickle".format(args.logdir))
             if args.checkp:
                 checkp = args.checkp
             else:
                 checkp = args.logdir.split("/")[1]
 
-        network.outer_model.save_weights('./checkpoints/' + checkp)
+        if args.chief:
+            network.outer_model.save_weights('./checkpoints/' + checkp)
         output_file = args.logdir.split("/")[1]
-        print(output_file)
+        if not args.quiet:
+            print(output_file)
 
         if args.test:
-            test_eval(predict=open("./" + output_file + "_vysledky", "w"))
+            test_eval(predict=open("./" + output_file + "_vysledky", "w") if args.chief else None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import http.server
+import io
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.request
+
+import morpho_dataset
+
+
+class TaggerServer:
+    # Keeps a trained network loaded and tags the sentences of concurrent requests
+    # together, in micro-batches of about max_batch sentences. A request waits at most
+    # max_latency seconds for other requests to fill its batch.
+    class _Request:
+        def __init__(self, lines, sentences, tokens):
+            self.lines = lines
+            self.sentences = sentences
+            self.tokens = tokens
+            self.arrival = time.monotonic()
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, network, args, bert=None, max_batch=64, max_latency=0.05):
+        self._network = network
+        self._args = args
+        self._bert = bert
+        self._max_batch = max_batch
+        self._max_latency = max_latency
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._counters = dict(requests=0, sentences=0, tokens=0, batches=0, errors=0)
+        self._busy = 0.0
+
+        self._worker = threading.Thread(target=self._tag_batches, daemon=True)
+        self._worker.start()
+
+    @staticmethod
+    def _input_lines(sentences):
+        # Every token is either a form, or a list of the form, lemma, tag and
+        # optionally the lemma-tag pairs of its morphological analyses
+        if not isinstance(sentences, list):
+            raise ValueError("Expected a list of sentences")
+        lines, tokens = [], 0
+        for sentence in sentences:
+            if not isinstance(sentence, list) or not sentence:
+                raise ValueError("Every sentence must be a nonempty list of tokens")
+            for token in sentence:
+                fields = [token, "_", "_"] if isinstance(token, str) else token
+                if not isinstance(fields, list) or len(fields) < 3 or len(fields) % 2 == 0 or \
+                        not all(isinstance(field, str) and field and not any(c in field for c in "\t\r\n")
+                                for field in fields):
+                    raise ValueError("Invalid token {}".format(json.dumps(token, ensure_ascii=False)))
+                lines.append("\t".join(fields) + "\n")
+            lines.append("\n")
+            tokens += len(sentence)
+        return lines, tokens
+
+    def tag(self, sentences):
+        # Returns the [form, lemma, tag] triples of the tokens of all sentences
+        lines, tokens = self._input_lines(sentences)
+        if not sentences:
+            return []
+
+        request = self._Request(lines, len(sentences), tokens)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            busy = self._busy
+        uptime = time.monotonic() - self._started
+        stats["queue_depth"] = self._queue.qsize()
+        stats["uptime"] = uptime
+        stats["busy"] = busy
+        stats["sentences_per_second"] = stats["sentences"] / busy if busy else 0.
+        stats["tokens_per_second"] = stats["tokens"] / busy if busy else 0.
+        stats["mean_batch_sentences"] = stats["sentences"] / stats["batches"] if stats["batches"] else 0.
+        return stats
+
+    def _tag_batches(self):
+        while True:
+            # Collect the requests arriving until the batch is full or the oldest one is due
+            batch = [self._queue.get()]
+            sentences = batch[0].sentences
+            deadline = batch[0].arrival + self._max_latency
+            while sentences < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                sentences += request.sentences
+
+            start = time.monotonic()
+            try:
+                tagged = self._tag_lines([line for request in batch for line in request.lines])
+                for request in batch:
+                    request.result, tagged = tagged[:request.sentences], tagged[request.sentences:]
+            except Exception as error:
+                for request in batch:
+                    request.error = error
+            elapsed = time.monotonic() - start
+
+            with self._lock:
+                self._counters["batches"] += 1
+                self._busy += elapsed
+                for request in batch:
+                    if request.error is None:
+                        self._counters["requests"] += 1
+                        self._counters["sentences"] += request.sentences
+                        self._counters["tokens"] += request.tokens
+                    else:
+                        self._counters["errors"] += 1
+            for request in batch:
+                request.done.set()
+
+    def _tag_lines(self, lines):
+        dataset = morpho_dataset.MorphoDataset(lines, train=self._args.train, shuffle_batches=False,
+                                               bert=self._bert, max_tokens=self._args.max_tokens)
+        output = io.StringIO()
+        self._network.predict(dataset, self._args, output)
+
+        sentences, sentence = [], []
+        for line in output.getvalue().split("\n"):
+            if line:
+                sentence.append(line.split("\t")[:3])
+            elif sentence:
+                sentences.append(sentence)
+                sentence = []
+        return sentences
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def _reply(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._reply(200, self.server.tagger.stats())
+        else:
+            self._reply(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/tag":
+            return self._reply(404, {"error": "Unknown path {}".format(self.path)})
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            if not isinstance(data, dict) or "sentences" not in data:
+                raise ValueError("Expected a JSON object with the list of sentences as its sentences field")
+            sentences = data["sentences"]
+            self.server.tagger._input_lines(sentences)
+        except (ValueError, TypeError) as error:
+            return self._reply(400, {"error": str(error)})
+        try:
+            self._reply(200, {"sentences": self.server.tagger.tag(sentences)})
+        except Exception as error:
+            self._reply(500, {"error": str(error)})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(tagger, host="localhost", port=8000, verbose=False):
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.tagger = tagger
+    server.verbose = verbose
+    print("Serving on http://{}:{}/".format(*server.server_address[:2]), file=sys.stderr, flush=True)
+    server.serve_forever()
+
+
+def tag(url, sentences):
+    # Client side of the server, tagging the given sentences of forms
+    request = urllib.request.Request(url.rstrip("/") + "/tag", method="POST",
+                                     data=json.dumps({"sentences": sentences}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode("utf-8"))["sentences"]
+
+
+def stats(url):
+    with urllib.request.urlopen(url.rstrip("/") + "/stats") as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def main(args):
+    import argparse
+
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--client", default=None, type=str,
+                        help="Tag the standard input using the server running at the given URL.")
+    parser.add_argument("--client_batch", default=64, type=int, help="Sentences sent in one client request.")
+    parser.add_argument("--gpu", default=0, type=int, help="Allow the server to use GPUs.")
+    parser.add_argument("--host", default="localhost", type=str, help="Server host.")
+    parser.add_argument("--max_batch", default=64, type=int, help="Maximum sentences tagged together.")
+    parser.add_argument("--max_latency", default=0.05, type=float,
+                        help="Maximum seconds a request waits for a batch to fill up.")
+    parser.add_argument("--port", default=8000, type=int, help="Server port.")
+    parser.add_argument("--stats", default=0, type=int, help="With --client, print the server statistics.")
+    parser.add_argument("--verbose", default=0, type=int, help="Log every request.")
+    args, tagger_args = parser.parse_known_args(args)
+
+    if args.client:
+        if args.stats:
+            print(json.dumps(stats(args.client), indent=2))
+            return
+
+        # Tag the vertical input (one form per line, the remaining columns are ignored)
+        def flush(sentences):
+            for sentence in tag(args.client, sentences):
+                for token in sentence:
+                    print("\t".join(token))
+                print()
+            sentences.clear()
+
+        sentences, sentence = [], []
+        for line in sys.stdin:
+            line = line.rstrip("\r\n")
+            if line:
+                sentence.append(line.split("\t")[0])
+            elif sentence:
+                sentences.append(sentence)
+                sentence = []
+                if len(sentences) >= args.client_batch:
+                    flush(sentences)
+        if sentence:
+            sentences.append(sentence)
+        flush(sentences)
+        return
+
+    import tensorflow as tf
+    import morpho_tagger_2
+
+    if not args.gpu:
+        tf.config.set_visible_devices([], "GPU")
+
+    # The tagger options are those of morpho_tagger_2.py, without the input data
+    tagger_args, name = morpho_tagger_2.parse_args(tagger_args + ["-"])
+    if tagger_args.predict is None:
+        parser.error("the tagger option --predict is required")
+
+    tagger_args.strategy = morpho_tagger_2.create_strategy(tagger_args)
+    morpho_tagger_2.load_embeddings(tagger_args)
+    model_bert = None
+    if tagger_args.bert or tagger_args.bert_model:
+        with tagger_args.strategy.scope():
+            model_bert = morpho_tagger_2.BertModel(name, tagger_args)
+    tagger_args.train = morpho_dataset.MorphoDataset.load_mappings("models/{}/mappings.pickle".format(tagger_args.exp))
+    network = morpho_tagger_2.create_network(tagger_args, model_bert)
+    network.outer_model.load_weights(tagger_args.predict)
+
+    tagger = TaggerServer(network, tagger_args, model_bert, max_batch=args.max_batch, max_latency=args.max_latency)
+    serve(tagger, args.host, args.port, args.verbose)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
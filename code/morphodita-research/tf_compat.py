@@ -0,0 +1,65 @@
+import inspect
+
+import tensorflow as tf
+
+# The requirements pin TensorFlow 2.1 (and 2.3 for the sentiment analysis), where several
+# APIs used by the opt-in training options exist only under their experimental names;
+# these helpers call whichever variant the running TensorFlow provides. The distributed
+# training is the exception, it needs TensorFlow 2.4 and is refused by older versions.
+
+DISTRIBUTE_VERSION = (2, 4)
+
+
+def function(python_function, jit_compile=False, **kwargs):
+    # A tf.function, compiled by XLA if requested (the option is experimental_compile before TF 2.5)
+    if jit_compile:
+        option = "jit_compile" if "jit_compile" in inspect.signature(tf.function).parameters else "experimental_compile"
+        kwargs[option] = True
+    return tf.function(python_function, **kwargs)
+
+
+def mixed_precision_policy():
+    # float16 with loss scaling on GPU, bfloat16 (which has the range of float32) on CPU
+    return "mixed_float16" if tf.config.list_logical_devices("GPU") else "mixed_bfloat16"
+
+
+def set_mixed_precision_policy(policy):
+    if hasattr(tf.keras.mixed_precision, "set_global_policy"):
+        tf.keras.mixed_precision.set_global_policy(policy)
+    else:
+        tf.keras.mixed_precision.experimental.set_policy(policy)
+
+
+def loss_scale_optimizer(optimizer):
+    # The optimizer with dynamic loss scaling, needed by the float16 mixed precision
+    if hasattr(tf.keras.mixed_precision, "LossScaleOptimizer"):
+        return tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+    return tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, "dynamic")
+
+
+def check_distribute():
+    # The distributed training applies the gradients without aggregating them (since TF 2.2),
+    # distributes the datasets and values from functions and traces the training step with the
+    # element_spec of the distributed dataset (both since TF 2.4)
+    version = tuple(int(part) for part in tf.__version__.split(".")[:2])
+    if version < DISTRIBUTE_VERSION:
+        raise RuntimeError("The --distribute and --cpu_replicas options require TensorFlow {}.{} or newer, "
+                           "found {}".format(*DISTRIBUTE_VERSION, tf.__version__))
+
+
+def is_multi_worker_chief():
+    # Whether this worker is the chief of a multi-worker training (either the chief task or
+    # the first worker if there is none), read from the TF_CONFIG by the resolver directly
+    resolver = tf.distribute.cluster_resolver.TFConfigClusterResolver()
+    if resolver.task_type in [None, "chief"]:
+        return True
+    return resolver.task_type == "worker" and resolver.task_id == 0 and "chief" not in resolver.cluster_spec().jobs
+
+
+def checkpoint_save_options():
+    # The keyword arguments of CheckpointManager.save to write asynchronously; this is supported
+    # only since TF 2.9 (and CheckpointOptions since TF 2.3), older versions save synchronously
+    options = getattr(tf.train, "CheckpointOptions", None)
+    if options is None or "experimental_enable_async_checkpoint" not in inspect.signature(options).parameters:
+        return {}
+    return dict(options=options(experimental_enable_async_checkpoint=True))
@@ -6,6 +6,7 @@ import datetime
 import os
 import re
 import sys
+import tempfile
 import numpy as np
 import tensorflow as tf
 import transformers
@@ -21,6 +22,11 @@ from text_classification_dataset import TextClassificationDataset
 
 from sentiment_dataset import SentimentDataset
 
+# The GradientAccumulator and tf_compat are shared with the tagger in morphodita-research
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "morphodita-research"))
+from gradient_accumulator import GradientAccumulator
+import tf_compat
+
 
 class Network:
     def __init__(self, args, labels):
@@ -28,6 +34,12 @@ class Network:
         subwords = tf.keras.layers.Input(shape=[None], dtype=tf.int32)
         inp = [subwords]
         self.labels = labels
+        self.args = args
+        # The model and the optimizer are created in the scope of this strategy,
+        # which is the default one (without any replicas) unless --distribute is given
+        self._strategy = tf.distribute.get_strategy()
+        self._distributed = tf.distribute.has_strategy()
+        self._accumulate = args.accu > 1
 
         # bert model
         if "robeczech" not in args.bert:
@@ -60,10 +72,12 @@ class Network:
                 , axis=0)  # prumerovani vrstev
         output = tf.keras.layers.Dense(768, activation=tf.nn.tanh)(output[:, 0, :])
         dropout = tf.keras.layers.Dropout(args.dropout)(output)
-        predictions = tf.keras.layers.Dense(labels, activation=tf.nn.softmax)(dropout)
+        # The softmax (and therefore the loss) is always computed in float32
+        predictions = tf.keras.layers.Dense(labels, activation=tf.nn.softmax, dtype=tf.float32)(dropout)
 
         self.model = tf.keras.Model(inputs=inp, outputs=predictions)
         self.optimizer=tf.optimizers.Adam()
+        self._accumulator = GradientAccumulator()
         if args.decay_type is not None:
             decay_steps = args.steps_in_epoch * (args.epochs[0][0] - args.warmup_decay)
             if args.decay_type == "i":
@@ -75,18 +89,36 @@ class Network:
             self.optimizer.learning_rate = WarmUp(initial_learning_rate=args.epochs[0][1],
                                                    warmup_steps=args.warmup_decay * args.steps_in_epoch,
                                                    decay_schedule_fn=learning_rate_fn)
+        # The float16 mixed precision needs loss scaling, bfloat16 has the range of float32
+        self._loss_scaling = bool(args.mixed_precision) and tf_compat.mixed_precision_policy() == "mixed_float16"
+        if self._loss_scaling:
+            self.optimizer = tf_compat.loss_scale_optimizer(self.optimizer)
         if args.model != None:
             self.model.load_weights(args.model)
+        # The losses are summed over the examples and divided by their number on all replicas
         if args.label_smoothing:
-            self.loss = tf.losses.CategoricalCrossentropy()
+            self.loss = tf.losses.CategoricalCrossentropy(reduction=tf.losses.Reduction.NONE)
         else:
-            self.loss = tf.losses.SparseCategoricalCrossentropy()
+            self.loss = tf.losses.SparseCategoricalCrossentropy(reduction=tf.losses.Reduction.NONE)
+
+        # Only the chief writes the summaries, the other workers of a multi-worker training
+        # write theirs into a temporary directory
+        self._writer = tf.summary.create_file_writer(args.logdir if args.chief else tempfile.mkdtemp(),
+                                                     flush_millis=10 * 1000)
+
+        # With --jit_compile, the model computations (but not the summaries) are compiled by XLA
+        self._train_step = tf_compat.function(self._train_step, jit_compile=args.jit_compile,
+                                              experimental_relax_shapes=True)
+        self._evaluate_step = tf_compat.function(self._evaluate_step, jit_compile=args.jit_compile,
+                                                 experimental_relax_shapes=True)
+        self._apply_accumulated = tf.function(self._apply_accumulated, experimental_relax_shapes=True)
+
+    def create_metrics(self):
+        # The metrics are updated outside of the replicas (by the values reduced over all
+        # the replicas of all the workers), so they are created outside of the strategy scope
         self.metrics = {"loss": tf.metrics.Mean(), "F1": tf.metrics.Mean()}
 
-        self._writer = tf.summary.create_file_writer(args.logdir, flush_millis=10 * 1000)
-
-    @tf.function(experimental_relax_shapes=True)
-    def train_batch(self, inputs, gold_data, tvs):
+    def _train_step(self, inputs, gold_data, tvs):
         with tf.GradientTape() as tape:
 
             probabilities = self.model(inputs, training=True)
@@ -99,26 +131,80 @@ class Network:
             #print(str(len(gold_data)))
             #print(str(len(inputs)))
             if args.label_smoothing:
-                loss += self.loss(tf.one_hot(gold_data, self.labels) * (1 - args.label_smoothing)
-                    + args.label_smoothing /  self.labels, probabilities)
+                loss += tf.reduce_sum(self.loss(tf.one_hot(gold_data, self.labels) * (1 - args.label_smoothing)
+                    + args.label_smoothing /  self.labels, probabilities))
             else:
-                loss += self.loss(tf.convert_to_tensor(gold_data), probabilities)
+                loss += tf.reduce_sum(self.loss(tf.convert_to_tensor(gold_data), probabilities))
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if self._loss_scaling else loss
+
+        gradients = tape.gradient(scaled_loss, tvs)
+        if self._loss_scaling:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        return loss, tf.cast(tf.shape(probabilities)[0], tf.float32), gradients
+
+    def _train_replica(self, inputs, gold_data, tvs):
+        loss, examples, gradients = self._train_step(inputs, gold_data, tvs)
+        metrics = loss, examples
+
+        # The gradients of the mean loss over the examples of all replicas, summed over the replicas.
+        # They are applied right away, unless they are accumulated over several batches.
+        if self._distributed:
+            context = tf.distribute.get_replica_context()
+            examples = context.all_reduce(tf.distribute.ReduceOp.SUM, examples)
+            summed = iter(context.all_reduce(tf.distribute.ReduceOp.SUM, [g for g in gradients if g is not None]))
+            gradients = [None if g is None else next(summed) for g in gradients]
+        examples = tf.maximum(examples, 1.)
+        gradients = [None if g is None else tf.IndexedSlices(g.values / examples, g.indices, g.dense_shape)
+                     if isinstance(g, tf.IndexedSlices) else g / examples for g in gradients]
+        if not self._accumulate:
+            self._apply_replica(gradients, tvs)
+            gradients = []
+        return metrics, gradients
 
-        gradients = tape.gradient(loss, tvs)
+    @tf.function(experimental_relax_shapes=True)
+    def train_batch(self, inputs, gold_data, tvs):
+        if not self._distributed:
+            (loss, examples), gradients = self._train_replica(inputs, gold_data, tvs)
+        else:
+            (loss, examples), gradients = self._strategy.run(
+                lambda inputs, gold_data: self._train_replica(inputs, gold_data, tvs),
+                args=(inputs, gold_data))
+            # The metrics are updated by the sums over all the replicas of all the workers
+            loss, examples = [self._strategy.reduce(tf.distribute.ReduceOp.SUM, value, axis=None)
+                              for value in [loss, examples]]
+        self.metrics["loss"](loss / tf.maximum(examples, 1.), examples)
+        return gradients
 
+    def _write_train_summaries(self):
+        # The training metrics are running means since the previous summaries, so they are restarted
         tf.summary.experimental.set_step(self.optimizer.iterations)
         with self._writer.as_default():
             for name, metric in self.metrics.items():
+                tf.summary.scalar("train/{}".format(name), metric.result())
                 metric.reset_states()
-            self.metrics["loss"](loss)
 
-            for name, metric in self.metrics.items():
-                tf.summary.scalar("train/{}".format(name), metric.result())
-        return gradients
+    def _distribute(self, *arrays):
+        # Every replica gets its own (possibly empty) part of the batch with --distribute
+        if not self._distributed:
+            return arrays
+        parts = [np.array_split(array, self._strategy.num_replicas_in_sync) for array in arrays]
+        return self._strategy.experimental_distribute_values_from_function(
+            lambda context: tuple(part[context.replica_id_in_sync_group] for part in parts))
+
+    def _apply_accumulated(self, gradients, tvs):
+        # The accumulated gradients are already summed over the replicas, every replica applies them as they are
+        if self._distributed:
+            self._strategy.run(self._apply_replica, args=(gradients, tvs))
+        else:
+            self._apply_replica(gradients, tvs)
 
+    def _apply_replica(self, gradients, tvs):
+        # With --distribute, the optimizer must not aggregate the gradients again
+        # (the default strategy does not accept the option before TF 2.2)
+        aggregate = dict(experimental_aggregate_gradients=False) if self._distributed else {}
+        self.optimizer.apply_gradients(zip(gradients, tvs), **aggregate)
 
     def train_epoch(self, dataset, args):
-        num_gradients = 0
         tvs = self.model.trainable_variables
         #print("trainable")
         #print(str(len(tvs)))
@@ -126,49 +212,26 @@ class Network:
 
         # if args.freeze:
         #     tvs = [tvar for tvar in tvs if not tvar.name.startswith('bert')]
+        for metric in self.metrics.values():
+            metric.reset_states()
+        summary_steps = 0
         for batch in dataset.batches(size=args.batch_size):
-            tf.print(batch[0])
             tg = self.train_batch(
-                batch[0],
-                batch[1], tvs)
-
-            if args.accu < 2:
-                self.optimizer.apply_gradients(zip(tg, tvs))
-            else:
-                if num_gradients == 0:
-                    gradients = []
-                    for index, g in enumerate(tg):
-                        if g == None:
-                            gradients.append(None)
-                        elif not isinstance(g, tf.IndexedSlices):
-                            gradients.append(g.numpy())
-                        else:
-                            gradients.append([(g.values.numpy(), g.indices.numpy())])
-
-                else:
-                    for g, ng in zip(gradients, tg):
-                        if ng != None:
-                            if isinstance(g, list):
-                                g.append((ng.values.numpy(), ng.indices.numpy()))
-                            else:
-                                g += ng.numpy()
-                tf.print("num gradients " + str(num_gradients))
-                num_gradients += 1
-                if num_gradients == args.accu:
-                    gradients = [tf.IndexedSlices(*map(np.concatenate, zip(*g))) if isinstance(g, list) else g for g in
-                                 gradients]
-                    if args.fine_lr > 0:
-                        variables = self.model.trainable_variables
-                        var1 = variables[0: args.lr_split]
-                        var2 = variables[args.lr_split:]
-                        tg1 = gradients[0: args.lr_split]
-                        tg2 = gradients[args.lr_split:]
-
-                        self.optimizer.apply_gradients(zip(tg2, var2))
-                        self.fine_optimizer.apply_gradients(zip(tg1, var1))
-                    else:
-                        self.optimizer.apply_gradients(zip(gradients, tvs))
-                    num_gradients = 0
+                *self._distribute(batch[0], batch[1]), tvs)
+            summary_steps += 1
+            if summary_steps == args.summary_steps:
+                self._write_train_summaries()
+                summary_steps = 0
+
+            if self._accumulate:
+                # The summed gradients are the same on all replicas, those of the first one are accumulated
+                self._accumulator.accumulate([None if g is None else self._strategy.experimental_local_results(g)[0]
+                                              for g in tg])
+                if self._accumulator.steps == args.accu:
+                    self._apply_accumulated(self._accumulator.gradients(), tvs)
+                    self._accumulator.reset()
+        if summary_steps:
+            self._write_train_summaries()
 
     def train(self, data, args):
         for e, lr in args.epochs:
@@ -177,13 +240,13 @@ class Network:
                     lr = lr / args.accu
                 self.optimizer.learning_rate.assign(lr)
             for i in range(e):
-                print("epoch " + str(i))
                 network.train_epoch(data.train, args)
                 if args.kfold <= 0:
                     network.evaluate(data.dev, "dev", args)
                     metrics = {name: metric.result() for name, metric in self.metrics.items()}
                     metrics_log = ", ".join(("{}: {:.2f}".format(metric, 100 * metrics[metric]) for metric in metrics))
-                    print("Dev, epoch {}, lr {}, {}".format(i, lr, metrics_log))
+                    if not args.quiet:
+                        print("Dev, epoch {}, lr {}, {}".format(i, lr, metrics_log))
 
 
     def predict(self, dataset, args):
@@ -197,8 +260,7 @@ class Network:
     #     return self.model.evaluate(self._transform_dataset(dataset.data["tokens"]), np.asarray(dataset.data["labels"]), 16)
 
 
-    @tf.function(experimental_relax_shapes=True)
-    def evaluate_batch(self, inputs, factors):
+    def _evaluate_step(self, inputs, factors):
         probabilities = self.model(inputs, training=False)
         loss = 0
 
@@ -207,7 +269,12 @@ class Network:
             loss += self.loss(tf.one_hot(factors, self.labels), probabilities)
         else:
             loss += self.loss(tf.convert_to_tensor(factors), probabilities)
+        return probabilities, tf.reduce_mean(loss)
 
+    @tf.function(experimental_relax_shapes=True)
+    def evaluate_batch(self, inputs, factors):
+        # Every worker evaluates all the batches by itself, without the replicas
+        probabilities, loss = self._evaluate_step(inputs, factors)
         self.metrics["loss"](loss)
 
 
@@ -222,15 +289,9 @@ class Network:
             self.metrics["F1"](f1_score(batch[1], pred, average="weighted"))
 
     def _transform_dataset(self, dataset):
-        print(len(dataset))
         max_len = max(len(a) for a in dataset)
-        print(max_len)
-        print("max")
         data = []
         for i in dataset:
-            print(i)
-            print("i")
-
             max_l = max_len - len(i)
             data.append(i + [0]*max_l)
         
@@ -246,6 +307,11 @@ def main(args):
     parser.add_argument("--accu", default=1, type=int, help="accumulate batch size")
     parser.add_argument("--batch_size", default=4, type=int, help="Batch size.")
     parser.add_argument("--bert", default="bert-base-multilingual-uncased", type=str, help="BERT model.")
+    parser.add_argument("--cpu_replicas", default=0, type=int,
+                        help="Split the CPU into this many devices, i.e., to try --distribute locally.")
+    parser.add_argument("--distribute", default=None, type=str,
+                        help="Data-parallel training, either 'mirrored' (all local GPUs, or the CPU devices "
+                             "without them) or 'multi_worker' (several hosts described by TF_CONFIG).")
     parser.add_argument("--dropout", default=0.5, type=float, help="Dropout.")
     parser.add_argument("--epochs", default="10:5e-5,1:2e-5", type=str, help="Number of epochs.")
     parser.add_argument("--layers", default=None, type=str, help="Which layers should be used")
@@ -253,14 +319,20 @@ def main(args):
                         help="Number of warmup steps, than will be applied inverse square root decay")
     parser.add_argument("--checkp", default=None, type=str, help="Checkpoint name")
     parser.add_argument("--debug", default=True, type=int, help="use small debug data")
+    parser.add_argument("--jit_compile", default=0, type=int, help="Compile the train and evaluation steps by XLA.")
     parser.add_argument("--label_smoothing", default=0.03, type=float, help="Label smoothing.")
+    parser.add_argument("--mixed_precision", default=0, type=int,
+                        help="Use mixed precision, bfloat16 on CPU and float16 with loss scaling on GPU.")
     parser.add_argument("--model", default=None, type=str, help="Model for loading")
     parser.add_argument("--predict", default=None, type=str, help="predict only from given file.")
+    parser.add_argument("--quiet", default=0, type=int, help="Do not print the epoch results.")
     parser.add_argument("--datasets", default="csfd", type=str, help="Dataset for use")
     parser.add_argument("--english", default=0, type=float, help="add some english data for training.")
     parser.add_argument("--fine_lr", default=0, type=float, help="Learning rate for bert layers")
     parser.add_argument("--freeze", default=0, type=int, help="Freezing bert layers")
     parser.add_argument("--seed", default=42, type=int, help="Random seed.")
+    parser.add_argument("--summary_steps", default=100, type=int,
+                        help="Write the means of the training metrics every this many steps.")
     parser.add_argument("--verbose", default=False, action="store_true", help="Verbose TF logging.")
     parser.add_argument("--kfold", default=None, type=str,
                         help="Number of folds for cross-validation and the index of the fold")
@@ -283,6 +355,26 @@ def main(args):
     #    tf.config.threading.set_inter_op_parallelism_threads(args.threads)
     #    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
 
+    # The devices must be configured before TensorFlow initializes them
+    if args.distribute or args.cpu_replicas > 1:
+        tf_compat.check_distribute()
+    if args.cpu_replicas > 1:
+        cpu = tf.config.list_physical_devices("CPU")[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()] * args.cpu_replicas)
+
+    # The policy must be set before any layer (including the BERT ones) is created
+    if args.mixed_precision:
+        tf_compat.set_mixed_precision_policy(tf_compat.mixed_precision_policy())
+
+    if args.distribute == "mirrored":
+        devices = tf.config.list_logical_devices("GPU") or tf.config.list_logical_devices("CPU")
+        strategy = tf.distribute.MirroredStrategy([device.name for device in devices])
+    elif args.distribute == "multi_worker":
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    else:
+        strategy = tf.distribute.get_strategy()
+    args.chief = args.distribute != "multi_worker" or tf_compat.is_multi_worker_chief()
+
     # Report only errors by default
     if not args.verbose:
         os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
@@ -447,7 +539,9 @@ def main(args):
     if args.decay_type != None:
         args.steps_in_epoch = math.floor(len(data_result.train._data["tokens"]) / (args.batch_size * args.accu))
     # Create the network and train
-    network = Network(args, num_labels)
+    with strategy.scope():
+        network = Network(args, num_labels)
+    network.create_metrics()
 
     if args.predict is None:
         network.train(data_result, args)
@@ -458,6 +552,7 @@ def main(args):
         out_path = "sentiment_analysis_test.txt"
         test_prediction = []
         if os.path.isdir(args.logdir): out_path = os.path.join(args.logdir, out_path)
+        if not args.chief: out_path = os.path.join(tempfile.mkdtemp(), os.path.basename(out_path))
         with open(out_path, "w", encoding="ascii") as out_file:
             for label in network.predict(data_result.test, args):
                 label = np.argmax(label)
@@ -469,7 +564,8 @@ def main(args):
         else:
             checkp = args.logdir.split("/")[1]
 
-        network.model.save_weights('./checkpoints/' + checkp)
+        if args.chief:
+            network.model.save_weights('./checkpoints/' + checkp)
         print(args.logdir.split("/")[1])
 
         if data_result.test.data["labels"][0] != -1:
@@ -72,10 +72,6 @@ class TextClassificationDataset:
 
         def batches(self, size=None):
             permutation = self._shuffler.permutation(self._size) if self._shuffler else np.arange(self._size)
-            print("delka")
-            print(self._size)
-            print("skutecna")
-            print(len(self._data["tokens"]))
             data_tokens = self._data["tokens"]
             data_labels = self._data["labels"]
 